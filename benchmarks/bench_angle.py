@@ -0,0 +1,51 @@
+"""
+Benchmark of the vectorized angle functions against the scalar ones
+
+    python benchmarks/bench_angle.py [n]
+"""
+import os
+import sys
+from timeit import default_timer as timer
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from eso_down import angle
+
+def sexagesimal(n, rng):
+    ra = rng.uniform(0, 360, n)
+    dec = rng.uniform(-89, 89, n)
+    h = ra/15
+    ra_str = ['{:02d} {:02d} {:07.4f}'.format(int(x), int(x*60 % 60), x*3600 % 60) for x in h]
+    dec_str = ['{}{:02d} {:02d} {:06.3f}'.format('-' if d < 0 else '+', int(abs(d)), 
+                                                  int(abs(d)*60 % 60), abs(d)*3600 % 60) for d in dec]
+    return ra_str, dec_str
+
+def main(n=100000):
+    rng = np.random.default_rng(1)
+    ra_str, dec_str = sexagesimal(n, rng)
+
+    t = timer()
+    scalar = [angle.ra(s[0:2], s[3:5], s[6:])/3600 for s in ra_str]
+    scalar_dec = [angle.dec(s[0:3], s[3:6], s[6:])/3600 for s in dec_str]
+    t_scalar = timer() - t
+    t = timer()
+    vector = angle.hms2deg(ra_str)
+    vector_dec = angle.dms2deg(dec_str)
+    t_vector = timer() - t
+    print("parse {} coordinates: scalar {:.3f} s, vectorized {:.3f} s (max diff {:.2e} deg)".format(
+        n, t_scalar, t_vector, max(np.max(np.abs(vector - scalar)), np.max(np.abs(vector_dec - scalar_dec)))))
+
+    #archive rows scattered around a star close to RA = 0 and DEC = 60
+    ra0, dec0, dist = 0.001, 60., 30.
+    ra = (ra0 + rng.normal(0, 60/3600, n)) % 360
+    dec = dec0 + rng.normal(0, 30/3600, n)
+    t = timer()
+    box = (ra >= ra0 - dist/3600) & (ra <= ra0 + dist/3600) & (dec >= dec0 - dist/3600) & (dec <= dec0 + dist/3600)
+    t_box = timer() - t
+    t = timer()
+    cone = angle.cone(ra, dec, ra0, dec0, dist)
+    t_cone = timer() - t
+    print("position cut on {} rows: box {:.4f} s ({} rows), cone {:.4f} s ({} rows)".format(
+        n, t_box, np.count_nonzero(box), t_cone, np.count_nonzero(cone)))
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,163 @@
+"""
+Search, planning and download benchmark against the local mock archive
+
+    python benchmarks/bench_archive.py [--stars 1 91 1000] [--tables small large]
+        [--latency 0.01] [--bandwidth BYTES_PER_S] [--files 1] [--memory] [--bulk]
+        [--output FILE]
+
+For each scenario (number of stars x size of the tables) it measures
+searchStarbef/searchStaraft, the SNR planning (planner.snr_needed, used
+by calcula_SNR_nspec) and ANCILLARYdown of the files of each star, with
+the time and throughput of each step. With --memory the peak Python
+memory of each step is traced as well (tracemalloc makes the steps
+several times slower, so the times of the two modes should not be
+compared). With --bulk the tables come from ESOquery.queryBulk (a few
+ADQL cone queries) instead of one query for each star. The results are
+written to a JSON file to compare runs.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from timeit import default_timer as timer
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from eso_down.search import ESOquery
+from eso_down.metrics import Metrics
+from eso_down.throttle import RequestScheduler
+import eso_down.planner as planner
+from mock_server import MockArchive, MockEso, MockSimbad
+
+#rows of the table of each star and size of each tar
+TABLES = {'small': {'rows': 20, 'tar_size': 32*1024},
+          'large': {'rows': 2000, 'tar_size': 512*1024}}
+
+#default folder of the results (not tracked by git)
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def _peak_rss():
+    try:
+        import resource
+        #kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    except ImportError:
+        return None
+
+def _step(function, memory=False):
+    """
+    Time and peak Python memory (None if not traced) of function()
+    """
+    if memory:
+        tracemalloc.start()
+    t = timer()
+    result = function()
+    seconds = timer() - t
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+def client(archive, workers):
+    """
+    ESOquery talking to the mock archive, without rate limits
+    """
+    rates = {name: (1e6, 1e6) for name in RequestScheduler.RATES}
+    eq = ESOquery(workers=workers, scheduler=RequestScheduler(rates=rates), metrics=Metrics())
+    eq._eso = MockEso(archive.url, eq.session)
+    eq._surveys = eq._eso.list_surveys()
+    eq._simbad = MockSimbad(archive.url, eq.session)
+    eq.coords._simbad = eq._simbad
+    eq.datalink_url = archive.url+'/datalink/links'
+    eq.tap_url = archive.url+'/tap_obs/sync'
+    return eq
+
+def scenario(nstars, table, latency, bandwidth, files, workers, memory=False, bulk=False):
+    config = TABLES[table]
+    stars = ['HIP{}'.format(i) for i in range(1, nstars+1)]
+    result = {'stars': nstars, 'table': table, 'rows': config['rows'],
+              'tar_size': config['tar_size'], 'latency': latency, 'bandwidth': bandwidth, 'bulk': bulk}
+    folder = tempfile.mkdtemp(prefix='bench_archive_')
+    with MockArchive(latency, bandwidth, config['tar_size'], config['rows']) as archive:
+        eq = client(archive, workers)
+
+        def search():
+            eq.coords.resolve(stars)
+            if bulk:
+                eq.queryBulk(stars)
+            return [(eq.searchStarbef(s), eq.searchStaraft(s)) for s in stars]
+        searches, seconds, peak = _step(search, memory)
+        rows = sum(len(b) + len(a) for b, a in searches)
+        result['search'] = {'seconds': seconds, 'stars_per_s': nstars/seconds,
+                            'rows_kept': rows, 'peak_bytes': peak}
+
+        def plan():
+            out = []
+            for b, a in searches:
+                for epoch in (b, a):
+                    snr = np.sort(np.asarray(epoch['SNR (spectra)'], dtype=float))[::-1]
+                    out.append(planner.snr_needed(snr, target=1000))
+            return out
+        plans, seconds, peak = _step(plan, memory)
+        result['plan'] = {'seconds': seconds, 'epochs_per_s': len(plans)/seconds if seconds else None,
+                          'peak_bytes': peak}
+
+        def download():
+            paths = []
+            for star, (b, a) in zip(stars, searches):
+                if files and len(a):
+                    dest = os.path.join(folder, star)
+                    os.makedirs(dest, exist_ok=True)
+                    paths += eq.ANCILLARYdown(a[:files], dest)
+            return paths
+        paths, seconds, peak = _step(download, memory)
+        nbytes = sum(os.path.getsize(p) for p in paths)
+        result['download'] = {'seconds': seconds, 'files': len(paths), 'bytes': nbytes,
+                              'bytes_per_s': nbytes/seconds if seconds else None, 'peak_bytes': peak}
+        result['requests'] = dict(archive.requests)
+        result['metrics'] = eq.metrics.summary()
+        result['connections'] = eq.connection_stats()['total']
+    shutil.rmtree(folder, ignore_errors=True)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1].strip())
+    parser.add_argument('--stars', type=int, nargs='+', default=[1, 91, 1000])
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=list(TABLES))
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per file')
+    parser.add_argument('--files', type=int, default=1, help='files downloaded per star')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--memory', action='store_true', help='trace the peak memory of each step')
+    parser.add_argument('--bulk', action='store_true', help='search with queryBulk')
+    parser.add_argument('--output', default=os.path.join(RESULTS, 'bench_archive.json'))
+    args = parser.parse_args(argv)
+
+    results = []
+    for table in args.tables:
+        for nstars in args.stars:
+            r = scenario(nstars, table, args.latency, args.bandwidth, args.files, args.workers, args.memory, args.bulk)
+            results.append(r)
+            line = '{:>5} stars {:<6} search {:7.2f} s ({:6.1f} stars/s)  plan {:6.3f} s  download {:7.2f} s ({:6.1f} MB/s)'.format(
+                nstars, table, r['search']['seconds'], r['search']['stars_per_s'], r['plan']['seconds'],
+                r['download']['seconds'], (r['download']['bytes_per_s'] or 0)/1024**2)
+            if args.memory:
+                line += '  peak {:6.1f} MB'.format(max(r[k]['peak_bytes'] for k in ('search', 'plan', 'download'))/1024**2)
+            print(line)
+    out = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+           'numpy': np.__version__, 'workers': args.workers, 'files': args.files, 'memory': args.memory,
+           'max_rss_bytes': _peak_rss(), 'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(out, f, indent=1)
+    print('results written to {}'.format(args.output))
+    return out
+
+if __name__ == '__main__':
+    main()
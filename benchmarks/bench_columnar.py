@@ -0,0 +1,121 @@
+"""
+Memory and time of the planning path with the full archive tables and
+with the slim columnar arrays (eso_down.columnar)
+
+    python benchmarks/bench_columnar.py [--rows 10000 100000 500000] [--output FILE]
+
+Each case builds a table like the one of query_surveys (all its
+columns) for a star with a very large archive history, then splits it
+in epochs, sorts by SNR, plans with planner.snr_needed and extracts the
+dates and SNRs of the chosen spectra, as separa_epocas, calcula_SNR_nspec
+and get_info do. The time is measured without tracing, the peak memory
+in a second run with tracemalloc.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from timeit import default_timer as timer
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from eso_down.search import ESOquery
+import eso_down.planner as planner
+import eso_down.columnar as columnar
+
+#other columns of query_surveys, not used by the planning
+EXTRA = {'Instrument': 'U8', 'Object': 'U32', 'Program ID': 'U16', 'PI/Coi': 'U64',
+         'Collection': 'U8', 'Product category': 'U16', 'Release Date': 'U23',
+         'Exptime': float, 'Wavelength': 'U16', 'Product Version': 'U8',
+         'ABMAGLIM': float, 'TARGET': 'U32', 'Origfile': 'U64', 'Spectral resolution': float,
+         'Mjd-obs': float, 'Mjd-end': float, 'Telescope': 'U16', 'Filter': 'U16',
+         'Dataset ID': 'U64', 'Arcfile': 'U40'}
+
+#default folder of the results (not tracked by git)
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def archive_table(n, ra0=10., dec0=-30., seed=1):
+    """
+    Table with n rows and the columns of query_surveys
+    """
+    from astropy.table import Table
+    rng = np.random.default_rng(seed)
+    mjd = rng.uniform(52900, 60000, n)
+    dates = np.datetime_as_string(((mjd - 40587)*86400000).astype('int64').astype('datetime64[ms]'), unit='ms')
+    table = Table()
+    table['ARCFILE'] = np.char.add('ADP.', dates)
+    table['Date Obs'] = dates
+    table['SNR (spectra)'] = rng.uniform(5, 400, n)
+    table['RA'] = ra0 + rng.normal(0, 15/3600, n)
+    table['DEC'] = dec0 + rng.normal(0, 15/3600, n)
+    table['R (&lambda;/&delta;&lambda;)'] = np.where(rng.random(n) < 0.9, 115000, 80000)
+    for name, dtype in EXTRA.items():
+        if dtype is float:
+            table[name] = rng.random(n)
+        else:
+            table[name] = np.full(n, 'x'*int(np.dtype(dtype).itemsize//4), dtype=dtype)
+    return table
+
+def planning(eq, table, position, slim):
+    before, after = eq.splitEpochs(table, position, SNRmin=40, SNRmax=500, columnar=slim)
+    out = []
+    for files in (before, after):
+        if slim:
+            files = columnar.sort(files, 'SNR (spectra)', reverse=True)
+        else:
+            files.sort('SNR (spectra)', reverse=True)
+        SNR_total, nspec = planner.snr_needed(files['SNR (spectra)'], target=1000)
+        if slim:
+            dates = np.asarray(files['Date Obs'][:nspec])
+            SNRs = np.asarray(files['SNR (spectra)'][:nspec])
+        else:
+            #get_info before the columnar arrays: one row at a time
+            dates, SNRs = [], []
+            for f in files[:nspec]:
+                dates.append(f['Date Obs'])
+                SNRs.append(f['SNR (spectra)'])
+            dates, SNRs = np.array(dates), np.array(SNRs)
+        out.append((SNR_total, nspec, dates, SNRs))
+    return out
+
+def case(eq, n):
+    table = archive_table(n)
+    position = (10., -30.)
+    result = {'rows': n, 'table_bytes': int(sum(table[c].nbytes for c in table.colnames))}
+    for name, slim in (('table', False), ('columnar', True)):
+        t = timer()
+        out = planning(eq, table.copy(), position, slim)
+        seconds = timer() - t
+        copy = table.copy()
+        tracemalloc.start()
+        planning(eq, copy, position, slim)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del copy
+        result[name] = {'seconds': seconds, 'peak_bytes': peak,
+                        'nspec': [o[1] for o in out], 'SNR_total': [o[0] for o in out]}
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1].strip())
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--output', default=os.path.join(RESULTS, 'bench_columnar.json'))
+    args = parser.parse_args(argv)
+
+    eq = ESOquery()
+    results = []
+    for n in args.rows:
+        r = case(eq, n)
+        results.append(r)
+        print('{:>8} rows ({:6.1f} MB): table {:6.2f} s {:7.1f} MB peak   columnar {:6.2f} s {:7.1f} MB peak'.format(
+            n, r['table_bytes']/1024**2, r['table']['seconds'], r['table']['peak_bytes']/1024**2,
+            r['columnar']['seconds'], r['columnar']['peak_bytes']/1024**2))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=1)
+    print('results written to {}'.format(args.output))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Retries, backoff and resumed downloads against a faulty mock archive
+
+    python benchmarks/bench_faults.py [--stars 4] [--files 4] [--error-rate 0.3]
+        [--truncate-rate 0.5] [--output FILE]
+
+Each scenario starts MockArchive with one kind of fault (429 with
+Retry-After, 5xx errors, transfers cut in the middle, all of them) and
+runs the Simbad lookup, querySurveys and ANCILLARYdown of a few stars
+through RequestScheduler. It checks that every file arrived complete
+and with the right bytes, and records the retries and failures of each
+endpoint, the lowest concurrency limit reached (AIMD) and the faults
+injected. The exit status is 1 if a file is missing or wrong.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from timeit import default_timer as timer
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from eso_down.throttle import RequestScheduler
+from mock_server import MockArchive
+from bench_archive import client
+
+#default folder of the results (not tracked by git)
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def scenarios(error_rate, truncate_rate):
+    """
+    Name -> faults of MockArchive
+    """
+    return {'clean': {},
+            'throttled': {'error_rate': error_rate, 'error_status': 429, 'retry_after': 0.05},
+            'errors': {'error_rate': error_rate, 'error_status': (500, 502, 503, 504)},
+            'truncated': {'truncate_rate': truncate_rate},
+            'all': {'error_rate': error_rate, 'error_status': (429, 503), 'retry_after': 0.05,
+                    'truncate_rate': truncate_rate}}
+
+def check(path, size):
+    """
+    True if the file has size bytes and byte i is i % 256
+    """
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        return False
+    data = np.fromfile(path, dtype=np.uint8)
+    return bool(np.array_equal(data, (np.arange(size) % 256).astype(np.uint8)))
+
+def run(name, faults, nstars, files, tar_size=512*1024, workers=4):
+    stars = ['HIP{}'.format(i) for i in range(1, nstars+1)]
+    folder = tempfile.mkdtemp(prefix='bench_faults_')
+    with MockArchive(latency=0, tar_size=tar_size, **faults) as archive:
+        eq = client(archive, workers)
+        rates = {endpoint: (1e6, 1e6) for endpoint in RequestScheduler.RATES}
+        #enough retries for the 'all' scenario, where about 2 of 3 attempts fail
+        eq.scheduler = eq.coords.scheduler = RequestScheduler(rates=rates, retries=20, backoff=0.01,
+                                                              max_backoff=0.2)
+        #lowest limit of simultaneous requests of each endpoint (AIMD)
+        lowest, running = {}, [True]
+
+        def sample():
+            while running[0]:
+                for endpoint in list(eq.scheduler.counts):
+                    limit = eq.scheduler.limit(endpoint)
+                    lowest[endpoint] = min(lowest.get(endpoint, limit), limit)
+                time.sleep(0.002)
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        t = timer()
+        paths, errors = [], []
+        try:
+            eq.coords.resolve(stars)
+            for star in stars:
+                dest = os.path.join(folder, star)
+                os.makedirs(dest, exist_ok=True)
+                try:
+                    paths += eq.ANCILLARYdown(eq.querySurveys(star)[:files], dest)
+                except Exception as error:
+                    errors.append('{}: {!r}'.format(star, error))
+        finally:
+            running[0] = False
+            sampler.join()
+        seconds = timer() - t
+        good = sum(check(p, tar_size) for p in paths)
+        result = {'scenario': name, 'faults': faults, 'seconds': seconds,
+                  'expected': nstars*files, 'files': len(paths), 'good': good, 'errors': errors,
+                  'injected': dict(archive.faults), 'resumed': archive.resumed, 'counts': eq.scheduler.counts,
+                  'lowest_limit': lowest, 'requests': dict(archive.requests)}
+    shutil.rmtree(folder, ignore_errors=True)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1].strip())
+    parser.add_argument('--stars', type=int, default=4)
+    parser.add_argument('--files', type=int, default=4, help='files downloaded per star')
+    parser.add_argument('--error-rate', type=float, default=0.3, help='fraction of requests failed')
+    parser.add_argument('--truncate-rate', type=float, default=0.5, help='fraction of transfers cut')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', default=os.path.join(RESULTS, 'bench_faults.json'))
+    args = parser.parse_args(argv)
+
+    results, ok = [], True
+    for name, faults in scenarios(args.error_rate, args.truncate_rate).items():
+        r = run(name, faults, args.stars, args.files, workers=args.workers)
+        results.append(r)
+        ok = ok and r['good'] == r['expected'] and not r['errors']
+        retries = sum(c['retries'] for c in r['counts'].values())
+        failures = sum(c['failures'] for c in r['counts'].values())
+        print('{:<10} {:6.2f} s  files {:>3}/{:<3} ok  injected {:>3} status {:>3} cut  '
+              'resumed {:>3}  retries {:>4}  failures {:>2}  lowest limit {}'.format(
+                  name, r['seconds'], r['good'], r['expected'], r['injected']['status'],
+                  r['injected']['truncated'], r['resumed'], retries, failures,
+                  min(r['lowest_limit'].values()) if r['lowest_limit'] else '-'))
+        for error in r['errors']:
+            print('    ERROR {}'.format(error))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=1)
+    print('results written to {}'.format(args.output))
+    return ok
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
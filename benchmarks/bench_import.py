@@ -0,0 +1,50 @@
+"""
+Import time of the eso_down modules, each one in a fresh interpreter
+
+    python benchmarks/bench_import.py [repeats]
+
+Also checks that the heavy dependencies (astroquery, starsearch,
+astropy) are not loaded just by importing the package or creating an
+ESOquery.
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY = ['astroquery', 'starsearch', 'astropy', 'bs4']
+
+CASES = {'eso_down': 'import eso_down',
+         'eso_down.angle': 'import eso_down.angle',
+         'eso_down.planner': 'import eso_down.planner',
+         'eso_down.search': 'import eso_down.search',
+         'ESOquery()': 'from eso_down.search import ESOquery; ESOquery()'}
+
+SCRIPT = '''
+import sys, json
+from timeit import default_timer as timer
+t = timer()
+{code}
+t = timer() - t
+print(json.dumps({{'seconds': t, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def run(code):
+    out = subprocess.run([sys.executable, '-c', SCRIPT.format(code=code, heavy=HEAVY)],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main(repeats=5):
+    results = {}
+    for name, code in CASES.items():
+        runs = [run(code) for _ in range(repeats)]
+        results[name] = {'seconds': min(r['seconds'] for r in runs),
+                         'heavy': runs[0]['heavy']}
+        print('{:<18} {:7.1f} ms   heavy modules loaded: {}'.format(
+            name, 1000*results[name]['seconds'], ', '.join(results[name]['heavy']) or 'none'))
+    return results
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
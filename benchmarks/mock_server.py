@@ -0,0 +1,369 @@
+"""
+Local HTTP server that mimics the ESO and Simbad services used by eso_down
+
+    python benchmarks/mock_server.py [port]
+
+Paths served:
+
+    /tap/surveys?target=NAME     phase 3 table of a star (JSON, DALI style)
+    /tap_obs/sync (POST)         ADQL cone queries on ivoa.ObsCore (CSV or VOTable)
+    /simbad?ident=NAME[&ident=]  coordinates of the stars (JSON)
+    /datalink/links?ID=...       datalink rows with the ancillary tars (JSON)
+    /dataportal/file/NAME        synthetic tar (GET with Range, HEAD)
+
+Every answer is delayed by latency seconds and the files are sent at
+most at bandwidth bytes per second on each connection. The tables and
+coordinates are generated from the names, so they are the same in
+every run. Faults can be injected: a fraction of the answers replaced
+by an error status (with or without Retry-After) and a fraction of the
+file transfers cut in the middle. Byte i of every tar is i % 256, so a
+file resumed with Range can be checked.
+"""
+import hashlib
+import io
+import json
+import re
+import socket
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+def _seed(name):
+    return int(hashlib.md5(str(name).encode()).hexdigest()[:8], 16)
+
+def star_position(star):
+    """
+    (ra, dec) in degrees of a star, generated from its name
+    """
+    rng = np.random.default_rng(_seed(star))
+    return float(rng.uniform(0, 360)), float(rng.uniform(-89, 89))
+
+def survey_rows(star, rows):
+    """
+    Phase 3 table of a star: rows spectra before and after 2015-06-03,
+    most of them close to the star and with R = 115000
+
+    Returns
+    -------
+    table: dict
+        {'fields': [...], 'data': [[...], ...]}
+    """
+    rng = np.random.default_rng(_seed(star) + 1)
+    ra0, dec0 = star_position(star)
+    mjd = rng.uniform(52900, 60000, rows)
+    offset = np.where(rng.random(rows) < 0.9, 10., 120.)/3600
+    ra = (ra0 + rng.normal(0, 1, rows)*offset/max(np.cos(np.radians(dec0)), 0.01)) % 360
+    dec = np.clip(dec0 + rng.normal(0, 1, rows)*offset, -90, 90)
+    snr = rng.uniform(5, 400, rows)
+    res = np.where(rng.random(rows) < 0.9, 115000, 80000)
+    fields = ['ARCFILE', 'Object', 'Date Obs', 'SNR (spectra)', 'RA', 'DEC', 'R (&lambda;/&delta;&lambda;)']
+    data = []
+    for i in range(rows):
+        #MJD 40587 is 1970-01-01
+        date = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime((mjd[i] - 40587)*86400))
+        data.append(['HARPS.{}.{:06d}.fits'.format(date, _seed(star) % 1000000 + i), star, date,
+                     round(float(snr[i]), 1), float(ra[i]), float(dec[i]), int(res[i])])
+    return {'fields': [{'name': f} for f in fields], 'data': data}
+
+#cones of the ADQL queries of eso_down.tap.adql
+CIRCLE = re.compile(r"CIRCLE\('ICRS',\s*([-+\d.eE]+),\s*([-+\d.eE]+),\s*([-+\d.eE]+)\)")
+
+def obscore_rows(query, rows, format='csv'):
+    """
+    ObsCore answer of an ADQL query with cones: rows spectra around the
+    center of each cone, only the ones inside it are sent
+
+    Returns
+    -------
+    payload: bytes
+    """
+    from astropy.table import Table, vstack
+    parts = []
+    for ra0, dec0, radius in CIRCLE.findall(query):
+        ra0, dec0 = float(ra0), float(dec0)
+        rng = np.random.default_rng(_seed('{:.6f} {:.6f}'.format(ra0, dec0)))
+        offset = np.where(rng.random(rows) < 0.9, 10., 120.)/3600
+        ra = (ra0 + rng.normal(0, 1, rows)*offset/max(np.cos(np.radians(dec0)), 0.01)) % 360
+        dec = np.clip(dec0 + rng.normal(0, 1, rows)*offset, -90, 90)
+        mjd = rng.uniform(52900, 60000, rows)
+        part = Table({'dp_id': ['ADP.{:.6f}.{:06d}'.format(m, _seed(ra0) % 1000000 + i) for i, m in enumerate(mjd)],
+                      't_min': mjd,
+                      'snr': np.round(rng.uniform(5, 400, rows), 1),
+                      's_ra': ra, 's_dec': dec,
+                      'em_res_power': np.where(rng.random(rows) < 0.9, 115000., 80000.)})
+        cosd = (np.sin(np.radians(dec))*np.sin(np.radians(dec0)) +
+                np.cos(np.radians(dec))*np.cos(np.radians(dec0))*np.cos(np.radians(ra - ra0)))
+        parts.append(part[np.degrees(np.arccos(np.clip(cosd, -1, 1))) <= float(radius)])
+    table = vstack(parts) if parts else Table(names=['dp_id', 't_min', 'snr', 's_ra', 's_dec', 'em_res_power'],
+                                              dtype=['U32', float, float, float, float, float])
+    if format == 'votable':
+        out = io.BytesIO()
+        table.write(out, format='votable')
+        return out.getvalue()
+    out = io.StringIO()
+    table.write(out, format='ascii.csv')
+    return out.getvalue().encode()
+
+class MockArchive:
+    """
+    The mock services running in a background thread
+
+    Parameters
+    ----------
+    latency: float
+        Optional, seconds added to every answer
+        Default: latency = 0.01
+    bandwidth: float
+        Optional, bytes per second of each file transfer (None: unlimited)
+        Default: bandwidth = None
+    tar_size: int
+        Optional, size in bytes of the synthetic tars
+        Default: tar_size = 64 KB
+    rows: int
+        Optional, number of rows of the table of each star
+        Default: rows = 20
+    port: int
+        Optional, Default: port = 0 (any free port)
+    error_rate: float
+        Optional, fraction of the requests answered with an error status
+        Default: error_rate = 0
+    error_status: int or tuple of int
+        Optional, status of those answers (one chosen at random)
+        Default: error_status = 503
+    retry_after: float
+        Optional, seconds sent in the Retry-After header of the errors
+        Default: retry_after = None (no header)
+    truncate_rate: float
+        Optional, fraction of the file transfers closed after half of
+        the bytes
+        Default: truncate_rate = 0
+    seed: int
+        Optional, seed of the faults, Default: seed = 0
+    """
+    def __init__(self, latency=0.01, bandwidth=None, tar_size=64*1024, rows=20, port=0,
+                 error_rate=0., error_status=503, retry_after=None, truncate_rate=0., seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.tar_size = tar_size
+        self.rows = rows
+        self.error_rate = error_rate
+        self.error_status = tuple(np.atleast_1d(error_status).tolist())
+        self.retry_after = retry_after
+        self.truncate_rate = truncate_rate
+        self._random = np.random.default_rng(seed)
+        #requests received on each path and faults injected
+        self.requests = {}
+        self.faults = {'status': 0, 'truncated': 0}
+        #file transfers resumed with a Range after the first byte
+        self.resumed = 0
+        self._lock = threading.Lock()
+        self._block = bytes(range(256))*256
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                #headers and body are separate writes: without this each
+                #answer waits for the delayed ACK of the client
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                archive._answer(self, body=True)
+
+            def do_HEAD(self):
+                archive._answer(self, body=False)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode())
+                archive._tap(self, form.get('QUERY', [''])[0], form.get('FORMAT', ['votable'])[0])
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _json(self, handler, payload, body):
+        data = json.dumps(payload).encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        if body:
+            handler.wfile.write(data)
+
+    def _draw(self, rate):
+        with self._lock:
+            return rate > 0 and self._random.random() < rate
+
+    def _fault(self, handler):
+        """
+        Answer with an error status (error_rate of the times), True if so
+        """
+        if not self._draw(self.error_rate):
+            return False
+        with self._lock:
+            self.faults['status'] += 1
+            status = self.error_status[self._random.integers(len(self.error_status))]
+        handler.send_response(int(status))
+        if self.retry_after is not None:
+            handler.send_header('Retry-After', str(self.retry_after))
+        handler.send_header('Content-Length', '0')
+        handler.end_headers()
+        return True
+
+    def _answer(self, handler, body):
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+        prefix = '/'.join(url.path.split('/')[:3])
+        with self._lock:
+            self.requests[prefix] = self.requests.get(prefix, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self._fault(handler):
+            return
+        if url.path == '/tap/surveys':
+            self._json(handler, survey_rows(query['target'][0], self.rows), body)
+        elif url.path == '/simbad':
+            #reversed, as the Simbad TAP upload does not keep the order of the names
+            data = [[name] + list(star_position(name)) + [name] for name in query.get('ident', [])][::-1]
+            self._json(handler, {'fields': [{'name': 'main_id'}, {'name': 'ra'}, {'name': 'dec'},
+                                            {'name': 'user_specified_id'}], 'data': data}, body)
+        elif url.path == '/datalink/links':
+            data = []
+            for ID in query.get('ID', []):
+                arc = ID.split('?', 1)[-1]
+                data.append([ID, self.url+'/dataportal/file/'+arc, '', '#this', 'application/fits', self.tar_size])
+                data.append([ID, self.url+'/dataportal/file/'+arc.replace('.fits', '')+'.tar', '',
+                             '#auxiliary', 'application/x-tar', self.tar_size])
+            fields = ['ID', 'access_url', 'error_message', 'semantics', 'content_type', 'content_length']
+            self._json(handler, {'fields': [{'name': f} for f in fields], 'data': data}, body)
+        elif url.path.startswith('/dataportal/file/'):
+            self._file(handler, body)
+        else:
+            handler.send_response(404)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+
+    def _tap(self, handler, query, format):
+        with self._lock:
+            self.requests['/tap_obs/sync'] = self.requests.get('/tap_obs/sync', 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self._fault(handler):
+            return
+        data = obscore_rows(query, self.rows, format)
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/csv' if format == 'csv' else 'application/x-votable+xml')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _file(self, handler, body):
+        start = 0
+        header = handler.headers.get('Range')
+        if header:
+            start = int(header.split('=')[1].split('-')[0])
+        if start:
+            with self._lock:
+                self.resumed += 1
+        if start >= self.tar_size and header:
+            handler.send_response(416)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        handler.send_response(206 if start else 200)
+        handler.send_header('Content-Type', 'application/x-tar')
+        handler.send_header('Content-Length', str(self.tar_size - start))
+        handler.end_headers()
+        if not body:
+            return
+        left = self.tar_size - start
+        if left > 1 and self._draw(self.truncate_rate):
+            #the connection is closed before the announced length
+            with self._lock:
+                self.faults['truncated'] += 1
+            left = left//2
+            handler.close_connection = True
+        chunk = len(self._block) - 256
+        while left > 0:
+            n = min(chunk, left)
+            #byte i of the file is i % 256
+            offset = start % 256
+            handler.wfile.write(self._block[offset:offset+n])
+            start += n
+            left -= n
+            if self.bandwidth:
+                time.sleep(n/self.bandwidth)
+
+class MockEso:
+    """
+    Replaces the starsearch Eso service, asking the tables to MockArchive
+    """
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+        self.ROW_LIMIT = -1
+
+    def list_surveys(self):
+        return ['HARPS', 'FEROS', 'ESPRESSO']
+
+    def query_surveys(self, surveys=None, target=None):
+        from astropy.table import Table
+        rq = self.session.get(self.url+'/tap/surveys', params={'target': target})
+        rq.raise_for_status()
+        payload = rq.json()
+        names = [f['name'] for f in payload['fields']]
+        columns = list(zip(*payload['data'])) if payload['data'] else [[] for _ in names]
+        return Table([list(c) for c in columns], names=names)
+
+class MockSimbad:
+    """
+    Replaces the astroquery Simbad service, asking the coordinates to MockArchive
+    """
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+
+    def query_objects(self, names):
+        from astropy.table import Table
+        rq = self.session.get(self.url+'/simbad', params=[('ident', n) for n in names])
+        rq.raise_for_status()
+        data = rq.json()['data']
+        return Table(rows=data, names=['main_id', 'ra', 'dec', 'user_specified_id']) if data else None
+
+    def query_object(self, name):
+        return self.query_objects([name])
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    archive = MockArchive(port=port).start()
+    print('mock archive at {}'.format(archive.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        archive.stop()
@@ -1,8 +1,24 @@
 import eso_down
 from eso_down.search import ESOquery
-eq = ESOquery()
+from eso_down.manifest import RunManifest
+from eso_down.pipeline import Pipeline
+import eso_down.planner as planner
+from eso_down.report import TransferReport
+from eso_down.store import SpectrumStore
+from eso_down.extract import Extractor, HeaderIndex
+import eso_down.coadd as coadd
+import eso_down.columnar as columnar
+import eso_down.filters as filters
+from eso_down.metrics import Metrics
+from eso_down.sync import SyncState
+from eso_down.catalog import SpectrumCatalog
+# cache das buscas no ESO e no Simbad, reaproveitado entre execuções
+eq = ESOquery(workers = 4, cache = 'cache_eso.sqlite', coords = 'coordenadas.json')
 import numpy as np
 import os
+import shutil
+import subprocess
+import tempfile
 from timeit import default_timer as timer
 
 def calcula_SNR_nspec(files):
@@ -14,79 +30,61 @@ def calcula_SNR_nspec(files):
     files: tabela Astropy com os espectros e seus dados 
     '''
 
-    # counts = SNR²
-    counts, nspec = 0, 0
-
-    # soma SNR² até atingir counts = 10⁶ , que é SNR = 10³
-    while counts < 10**6:
-        counts += files['SNR (spectra)'][nspec]**2 
-        nspec += 1 # numero de espectros considerados para atingir o SNR
-        
-        if nspec == len(files): # se rodou todos espectros e não atingiu 1000
-            break
-            
-    SNR_total = np.sqrt(counts)
+    # soma acumulada de SNR² até atingir counts = 10⁶ , que é SNR = 10³
+    SNR_total, nspec = planner.snr_needed(files['SNR (spectra)'], target = SNR_ALVO)
 
     return SNR_total, nspec
 
 
-def busca_espectros_before(name_star):
+def separa_epocas(search, position):
 
     '''
-    Espectros antes do upgrade do HARPS.
-
-    Dado o nome da estrela, busca informações dela no Simbad e depois
-    procura os arquivos de espectro dela na Phase 3 da base de dados 
-    do ESO. Pode mudar SNRmin e SNRmax, assim como outros dados (ver
-    códigos originais na pasta "eso_down").
-
-    Retorna astropy Table com os arquivos dos espectros antes do 
-    upgrade do HARPS e suas informações, como data e SNR.
+    Separa o resultado de uma busca ja feita (eq.querySurveys) em antes
+    e depois do upgrade do HARPS, ordenados pelo SNR.
 
-    files_before: astropy table com a lista de arquivos e dados dos espectros
+    position: (RA, DEC) da estrela em graus (eq.position)
     '''
-    # tabela com infos de todos espectros da estrela com SNRmin e SNRmax definidos, antes do upgrade do HARPS
-    files_before = eq.searchStarbef(name_star, instrument = 'HARPS', SNRmin = 40, SNRmax = 500)
 
-    # ordenando a tabela pelo SNR, para as datas ficarem misturadas
-    files_before.sort('SNR (spectra)', reverse=True)
+    # tabelas com infos de todos espectros da estrela com SNRmin e SNRmax definidos, antes e depois do upgrade do HARPS
+    # (com COLUNAR, arrays estruturados so com as colunas usadas)
+    files_before, files_after = eq.splitEpochs(search, position, SNRmin = 40, SNRmax = 500, columnar = COLUNAR)
 
-    return files_before
+    # ordenando as tabelas pelo SNR, para as datas ficarem misturadas
+    files_before = columnar.sort(files_before, 'SNR (spectra)', reverse=True)
+    files_after = columnar.sort(files_after, 'SNR (spectra)', reverse=True)
 
+    return files_before, files_after
 
-def busca_espectros_after(name_star):
 
-    '''
-    Espectros depois do upgrade do HARPS.
+def download_spectra(files, nspec, path, manifest = None, star = None, on_done = None):  
     
-    Dado o nome da estrela, busca informações dela no Simbad e depois
-    procura os arquivos de espectro dela na Phase 3 da base de dados 
-    do ESO. Pode mudar SNRmin e SNRmax, assim como outros dados (ver
-    códigos originais na pasta "eso_down").
-
-    Retorna astropy Table com os arquivos dos espectros depois do 
-    upgrade do HARPS e suas informações, como data e SNR.
-
-    files_after: astropy table com a lista de arquivos e dados dos espectros
     '''
-    # tabela com infos de todos espectros da estrela com SNRmin e SNRmax definidos, antes do upgrade do HARPS
-    files_after = eq.searchStaraft(name_star, instrument = 'HARPS', SNRmin = 40, SNRmax = 500)
+    files: astropy table (ou dict com a coluna 'ARCFILE') com todos os arquivos de espectro
+    nspec: numero de arquivos para baixar
+    path: pasta para baixar os espectros
+    manifest: diario da execucao (RunManifest). Os arquivos ja baixados 
+              sao pulados e cada novo download e registrado
+    star: nome da estrela (usado no manifest)
+    on_done: funcao chamada como on_done(arcfile, endereco) apos cada download
+    '''
 
-    # ordenando a tabela pelo SNR, para as datas ficarem misturadas
-    files_after.sort('SNR (spectra)', reverse=True)
+    arcfiles = np.asarray(files['ARCFILE'][:nspec], dtype=str).tolist()
 
-    return files_after
+    if manifest is None:
+        eq.ANCILLARYdown(arq = {'ARCFILE': arcfiles}, downloadPath = path, on_done = on_done)
+        return
 
+    # pula os arquivos que ja foram baixados em execucoes anteriores
+    feitos = manifest.items(star, 'download')
+    faltam = [a for a in arcfiles if a not in feitos]
 
-def download_spectra(files, nspec, path):  
-    
-    '''
-    files: astropy table com todos os arquivos de espectro
-    nspec: numero de arquivos para baixar
-    path: pasta para baixar os espectros
-    '''
-    
-    eq.ANCILLARYdown(arq = files[:nspec], downloadPath = path)
+    def registra(arcfile, endereco):
+        manifest.mark(star, 'download', arcfile, path = endereco)
+        if on_done is not None:
+            on_done(arcfile, endereco)
+
+    if len(faltam) > 0:
+        eq.ANCILLARYdown(arq = {'ARCFILE': faltam}, downloadPath = path, on_done = registra)
 
 
 def get_info (files, nspec):
@@ -98,13 +96,11 @@ def get_info (files, nspec):
     nspec: numero de espectros baixados
     '''
 
-    dates, SNRs = [], []
+    # colunas inteiras de uma vez, sem percorrer as linhas
+    dates = np.asarray(files['Date Obs'][:nspec])
+    SNRs = np.asarray(files['SNR (spectra)'][:nspec])
 
-    for f in files[:nspec]:
-        dates.append(f['Date Obs'])
-        SNRs.append(f['SNR (spectra)'])
-
-    return np.array(dates), np.array(SNRs)
+    return dates, SNRs
 
 
 
@@ -123,141 +119,646 @@ def write_out_file(out_file_name, SNR_total, nspec, dates, SNRs):
     np.savetxt(out_file_name, np.array([dates, SNRs]).T, header = head, delimiter='   ', fmt = '%s')
 
 
-def baixar_antes(parent_path, star, SNR_before, nspec_before, files_before):
+# nome das epocas nas mensagens
+NOMES = {'Before': 'ANTES', 'After': 'DEPOIS'}
+
+
+def plano_epoca(files, SNR_total, nspec):
 
     '''
-    Baixa apenas os espectros antes do upgrade do HARPS
+    Espectros escolhidos de uma epoca, num dict que pode ser salvo no manifest
 
-    parent_path: pasta raiz para baixar os espectros
-    star: nome da estrela
+    files: astropy table com todos os arquivos (ordenada por SNR)
+    SNR_total, nspec: resultado de calcula_SNR_nspec
     '''
 
-    # cria pasta para colocar espectros antes do upgrade do HARPS
-    path_before = os.path.join(parent_path, star, "Before")
-    os.makedirs(path_before, exist_ok=True) 
+    dates, SNRs = get_info(files, nspec)
 
-    print("SNR atingido: {:.2f}\nNúmero de espectros: {}".format(SNR_before, nspec_before))
+    return {'SNR_total': float(SNR_total), 'nspec': int(nspec),
+            'ARCFILE': np.asarray(files['ARCFILE'][:nspec], dtype=str).tolist(),
+            'Date Obs': dates.astype(str).tolist(),
+            'SNR (spectra)': SNRs.astype(float).tolist()}
 
-    print("\nIniciando download dos espectros ANTES")
-    download_spectra(files_before, nspec_before, path_before)
 
-    # obtendo SNRs e datas dos espectros baixados
-    dates_before, SNRs_before = get_info(files_before, nspec_before)
-    
-    # salvando data e SNR de cada espectro baixado
+def planeja(files_before, files_after):
 
-    # nome dos arquivos 
-    out_file_before = path_before + '/info_spectra.txt'
+    '''
+    Decide se baixa os espectros ANTES, DEPOIS ou os dois, e quantos de cada.
 
-    # salvando
-    write_out_file(out_file_before, SNR_before, nspec_before, dates_before, SNRs_before)
+    Retorna dict epoca ('Before'/'After') -> plano_epoca
+    '''
+
+    plano = {}
+
+    # sem nenhum espectro nao ha o que baixar
+    if len(files_before) == 0 and len(files_after) == 0:
+        print("\nNenhum espectro encontrado\n")
+
+    # se nao tiver espectros ANTES, baixo apenas os DEPOIS, e vice-versa
+
+    elif len(files_after) == 0:
+
+        # calculando SNR e numero de espectros a baixar
+        SNR_before, nspec_before = calcula_SNR_nspec(files_before)
+        print("\nBaixando apenas espectros ANTES do upgrade\n")
+        plano['Before'] = plano_epoca(files_before, SNR_before, nspec_before)
 
+    elif len(files_before) == 0:
+
+        # calculando SNR e numero de espectros a baixar
+        SNR_after, nspec_after = calcula_SNR_nspec(files_after)
+        print("\nBaixando apenas espectros DEPOIS do upgrade\n")
+        plano['After'] = plano_epoca(files_after, SNR_after, nspec_after)
+
+
+    # se tiver espectros ANTES E DEPOIS, verifico se tem SNR > 400 em ambos os casos
+    # se ambos forem SNR < 400, baixo ANTES E DEPOIS
+    # se algum for SNR > 400, baixo apenas ele
+
+    else:
+        # calculando SNR e numero de espectros a baixar
+        SNR_before, nspec_before = calcula_SNR_nspec(files_before)
+        SNR_after, nspec_after = calcula_SNR_nspec(files_after)
+
+        # se espectros ANTES ou DEPOIS atingiram SNR = 400, baixo so eles. Se não, baixo antes E depois
+        if SNR_before >= 400:
+            # baixo o que tiver SNR maior
+            if SNR_before > SNR_after:
+                print("\nBaixando apenas espectros ANTES do upgrade\n")
+                plano['Before'] = plano_epoca(files_before, SNR_before, nspec_before)
+            else:
+                print("\nBaixando apenas espectros DEPOIS do upgrade\n")
+                plano['After'] = plano_epoca(files_after, SNR_after, nspec_after)
+         
+        elif SNR_after >= 400:
+            print("\nBaixando apenas espectros DEPOIS do upgrade\n")
+            plano['After'] = plano_epoca(files_after, SNR_after, nspec_after)
+
+        else:
+            print("Baixando espectros ANTES e DEPOIS do upgrade")
+            plano['Before'] = plano_epoca(files_before, SNR_before, nspec_before)
+            plano['After'] = plano_epoca(files_after, SNR_after, nspec_after)
 
+    return plano
 
-def baixar_depois(parent_path, star, SNR_after, nspec_after, files_after):
+
+def planeja_custo(files_before, files_after):
+
+    '''
+    Escolhe, entre os espectros ANTES e DEPOIS juntos, o conjunto que 
+    atinge SNR_ALVO baixando o menor volume de dados (tamanhos obtidos
+    no datalink, sem baixar nada). Alternativa a planeja (USE_PLANNER).
+
+    Retorna dict epoca ('Before'/'After') -> plano_epoca
+    '''
+
+    files = {'Before': files_before, 'After': files_after}
+    files = {epoca: files[epoca] for epoca in files if len(files[epoca]) > 0}
+
+    if len(files) == 0:
+        print("\nNenhum espectro encontrado\n")
+        return {}
+
+    snr = {epoca: np.asarray(files[epoca]['SNR (spectra)'], dtype=float) for epoca in files}
+    sizes = {epoca: eq.fileSizes(files[epoca]['ARCFILE']) for epoca in files}
+
+    resultado = planner.plan(snr, sizes, target = SNR_ALVO)
+    print("\nPlano: {} espectros, SNR previsto {:.2f}, {:.1f} MB".format(
+        resultado['nspec'], resultado['SNR'], resultado['bytes']/1024**2))
+
+    plano = {}
+    for epoca, indices in resultado['files'].items():
+        if len(indices) > 0:
+            escolhidos = files[epoca][indices]
+            SNR_total = np.sqrt(np.sum(np.asarray(escolhidos['SNR (spectra)'], dtype=float)**2))
+            plano[epoca] = plano_epoca(escolhidos, SNR_total, len(escolhidos))
+
+    return plano
+
+
+def baixar_epoca(parent_path, star, epoca, plano, manifest = None, extrator = None, catalogo = None):
 
     '''
-    Baixa apenas os espectros depois do upgrade do HARPS
+    Baixa os espectros de uma epoca (antes ou depois do upgrade do HARPS)
 
     parent_path: pasta raiz para baixar os espectros
     star: nome da estrela
+    epoca: 'Before' ou 'After'
+    plano: plano da epoca (ver plano_epoca)
+    manifest: diario da execucao (RunManifest)
+    extrator: Extractor que extrai os FITS de cada tar assim que ele
+              e baixado (None: os tars nao sao abertos)
+    catalogo: SpectrumCatalog onde cada espectro baixado vira uma linha,
+              gravadas em lote ao final da epoca
     '''
 
-    # cria pasta para colocar espectros antes do upgrade do HARPS
-    path_after = os.path.join(parent_path, star, "After")
-    os.makedirs(path_after, exist_ok=True) 
+    # cria pasta para colocar espectros da epoca
+    path = os.path.join(parent_path, star, epoca)
+    os.makedirs(path, exist_ok=True) 
 
-    print("SNR atingido: {:.2f}\nNúmero de espectros: {}".format(SNR_after, nspec_after))
+    print("{}: SNR atingido: {:.2f}\nNúmero de espectros: {}".format(star, plano['SNR_total'], plano['nspec']))
 
-    print("\nIniciando download dos espectros DEPOIS")
-    download_spectra(files_after, nspec_after, path_after)
+    print("\nIniciando download dos espectros {} de {}".format(NOMES[epoca], star))
+    # data e SNR de cada ARCFILE do plano, para o catalogo
+    linhas = dict(zip(plano['ARCFILE'], zip(plano['Date Obs'], plano['SNR (spectra)'])))
 
-    # obtendo SNRs e datas dos espectros baixados
-    dates_after, SNRs_after = get_info(files_after, nspec_after)
-    
-    # salvando data e SNR de cada espectro baixado
+    def on_done(arcfile, endereco):
+        if catalogo is not None:
+            catalogo.add(star, epoca, arcfile, *linhas.get(arcfile, (None, None)), path = endereco)
+        if extrator is not None:
+            extrator.submit(endereco, arcfile = arcfile)
+
+    download_spectra(plano, plano['nspec'], path, manifest, star, on_done)
+
+    if catalogo is not None:
+        # baixados em execucoes anteriores ao catalogo (linhas repetidas sao ignoradas)
+        if manifest is not None:
+            for arcfile in manifest.items(star, 'download'):
+                if arcfile in linhas:
+                    endereco = (manifest.get(star, 'download', arcfile) or {}).get('path')
+                    catalogo.add(star, epoca, arcfile, *linhas[arcfile], path = endereco)
+        catalogo.flush()
+
+
+def escreve_info(parent_path, star, epoca, plano, manifest = None, catalogo = None):
+
+    '''
+    Escreve o info_spectra.txt com data e SNR de cada espectro baixado.
+    Com o catalogo, os espectros ja estao nele e o txt so e gerado 
+    (a partir do catalogo) se INFO_TXT for True
+    '''
 
     # nome dos arquivos 
-    out_file_after = path_after + '/info_spectra.txt'
+    out_file = os.path.join(parent_path, star, epoca, 'info_spectra.txt')
 
     # salvando
-    write_out_file(out_file_after, SNR_after, nspec_after, dates_after, SNRs_after)
+    if catalogo is None:
+        write_out_file(out_file, plano['SNR_total'], plano['nspec'], 
+                       np.array(plano['Date Obs']), np.array(plano['SNR (spectra)']))
+    else:
+        catalogo.flush()
+        if not INFO_TXT or catalogo.write_info(out_file, star, epoca) == 0:
+            out_file = None
 
+    if manifest is not None:
+        manifest.mark(star, 'info', epoca, path = out_file)
 
-def main():
 
-    stars_problems = ['HIP3311', 'HIP96160']
+def gera_info(parent_path, catalogo, star_names = None):
 
-    star_names = []
+    '''
+    Gera (sob demanda) os info_spectra.txt de cada estrela e epoca a 
+    partir do catalogo
 
-    amostra = np.loadtxt("amostra_Giulia.csv", delimiter=',',dtype="str", unpack=True, skiprows=1)
+    star_names: estrelas (None: todas as do catalogo)
 
-    for s in amostra[0][79:]:
-        s = "HIP" + s
-        star_names.append(s) # 91 estrelas
+    Retorna o numero de arquivos escritos
+    '''
 
-    # raiz da pasta para salvar os espectros das estrelas
-    parent_path = '/home/giumartos/Desktop/Espectros'
+    escritos = 0
+    for star, epoca in catalogo.summary():
+        if star_names is not None and star not in star_names:
+            continue
+        path = os.path.join(parent_path, star, epoca)
+        os.makedirs(path, exist_ok=True)
+        escritos += catalogo.write_info(os.path.join(path, 'info_spectra.txt'), star, epoca) > 0
+
+    return escritos
+
+
+def coadiciona(parent_path, star, catalogo = None):
+
+    '''
+    Soma os espectros s1d extraidos de cada epoca da estrela (pesos SNR²)
+    e compara o SNR atingido com o SNR_total planejado no info_spectra.txt
+    (gerado do catalogo se ainda nao existe).
+    A soma e salva em <star>/<epoca>/stack.fits
+    '''
+
+    for epoca in NOMES:
+        path = os.path.join(parent_path, star, epoca)
+        if not os.path.isdir(path):
+            continue
+        info = os.path.join(path, 'info_spectra.txt')
+        if catalogo is not None and not os.path.exists(info):
+            catalogo.write_info(info, star, epoca)
+        try:
+            r = coadd.coadd_folder(path, output = os.path.join(path, 'stack.fits'))
+        except ValueError as erro:
+            print("{} {}: {}".format(star, epoca, erro))
+            continue
+        print("{} {}: {} espectros, SNR planejado {:.2f}, esperado {:.2f}, medido {:.2f}".format(
+            star, epoca, r['nspec'], r['SNR_planned'], r['SNR_expected'], r['SNR_measured']))
+
+
+def atualiza_plano(plano, novos):
 
+    '''
+    Acrescenta ao plano de uma estrela os espectros novos que aumentam
+    o SNR de cada epoca, partindo do SNR_total ja atingido (calcula_SNR_nspec
+    incremental). As epocas escolhidas na primeira execucao sao mantidas;
+    se o plano estava vazio, os novos espectros sao planejados do zero.
+
+    Uma epoca que nao estava no plano (ex.: so ANTES na primeira execucao
+    e agora espectros novos DEPOIS do upgrade) e planejada do zero com os
+    espectros novos, com a regra de planeja: entra se o plano nao chegou a
+    SNR 400 ou se ela atinge um SNR maior que o do plano. Se nao entra, a
+    epoca fica pendente: seus espectros nao devem ser marcados como vistos,
+    para voltarem na proxima sincronizacao somados aos que chegarem.
+
+    plano: dict epoca -> plano_epoca (do manifest)
+    novos: dict epoca -> astropy table com os espectros novos (ordenada por SNR)
+
+    Retorna o plano atualizado, um dict epoca -> plano_epoca so com os
+    espectros novos a baixar e a lista das epocas pendentes
+    '''
+
+    if len(plano) == 0:
+        acrescimos = planeja(novos['Before'], novos['After'])
+        return dict(acrescimos), acrescimos, []
+
+    plano, acrescimos = dict(plano), {}
+
+    for epoca in plano:
+        files = novos[epoca]
+        SNR_total, nspec = planner.snr_needed(files['SNR (spectra)'], target = SNR_ALVO, 
+                                              start = plano[epoca]['SNR_total'])
+        if nspec == 0:
+            continue
+        acrescimos[epoca] = plano_epoca(files, SNR_total, nspec)
+        antigo = plano[epoca]
+        plano[epoca] = {'SNR_total': float(SNR_total), 'nspec': antigo['nspec'] + nspec,
+                        'ARCFILE': antigo['ARCFILE'] + acrescimos[epoca]['ARCFILE'],
+                        'Date Obs': antigo['Date Obs'] + acrescimos[epoca]['Date Obs'],
+                        'SNR (spectra)': antigo['SNR (spectra)'] + acrescimos[epoca]['SNR (spectra)']}
+
+    # epocas fora do plano, comparadas com a melhor epoca ja planejada
+    SNR_plano = max(plano[epoca]['SNR_total'] for epoca in plano)
+    pendentes = []
+    for epoca in NOMES:
+        if epoca in plano or len(novos[epoca]) == 0:
+            continue
+        SNR_total, nspec = calcula_SNR_nspec(novos[epoca])
+        if SNR_plano < 400 or SNR_total > SNR_plano:
+            acrescimos[epoca] = plano_epoca(novos[epoca], SNR_total, nspec)
+            plano[epoca] = acrescimos[epoca]
+        else:
+            pendentes.append(epoca)
+
+    return plano, acrescimos, pendentes
+
+
+def sincroniza(star_names, parent_path, manifest, estado, extrator = None, catalogo = None):
+
+    '''
+    Modo incremental: para as estrelas ja processadas, busca no arquivo
+    apenas as observacoes a partir da ultima data vista (eq.queryBulk com
+    since), descarta os ARCFILEs ja vistos e baixa so os espectros novos
+    que aumentam o SNR, atualizando o plano e os info_spectra.txt.
+
+    estado: SyncState com a ultima data e os ARCFILEs vistos de cada estrela
+
+    Um erro numa estrela nao interrompe as outras: a estrela nao e marcada
+    como vista (sera sincronizada de novo na proxima execucao) e o erro e 
+    devolvido numa lista de (estrela, erro), como pipeline.errors
+    '''
+
+    # estrelas processadas antes do modo incremental: parte do que o manifest tem
+    for star in star_names:
+        if star not in estado:
+            estado.update(star, arcfiles = manifest.items(star, 'download'))
+
+    desde = {star: estado.since(star) for star in star_names}
+    tabelas = eq.queryBulk(star_names, instrument = 'HARPS', since = desde)
+
+    erros = []
     for star in star_names:
+        if star not in tabelas:
+            print("{}: sem coordenadas, nao sincronizada".format(star))
+            continue
+        try:
+            novos = estado.new_rows(star, tabelas[star])
+            vistos, escolhidos = tabelas[star], []
+            if len(novos) > 0:
+                files_before, files_after = separa_epocas(novos, eq.position(star))
+                epocas = {'Before': files_before, 'After': files_after}
+                plano, acrescimos, pendentes = atualiza_plano(manifest.get(star, 'plan') or {}, epocas)
+                escolhidos = [a for epoca in acrescimos for a in acrescimos[epoca]['ARCFILE']]
+                if len(pendentes) > 0:
+                    # voltam na proxima sincronizacao, somados aos que chegarem: 
+                    # so o que e anterior a eles conta como visto (a busca parte
+                    # da ultima data vista)
+                    inicio = min(np.nanmin(filters.mjd(epocas[e]['Date Obs'])) for e in pendentes)
+                    vistos = vistos[filters.mjd(vistos['Date Obs']) < inicio]
+                    for epoca in pendentes:
+                        print("{}: {} espectros novos {} ainda nao necessarios".format(
+                            star, len(epocas[epoca]), NOMES[epoca]))
+                for epoca in acrescimos:
+                    print("\n{}: {} espectros novos {}".format(star, acrescimos[epoca]['nspec'], NOMES[epoca]))
+                    baixar_epoca(parent_path, star, epoca, acrescimos[epoca], manifest, extrator, catalogo)
+                    escreve_info(parent_path, star, epoca, plano[epoca], manifest, catalogo)
+                if len(acrescimos) > 0:
+                    manifest.mark(star, 'plan', **plano)
+                elif len(pendentes) == 0:
+                    print("{}: {} espectros novos, nenhum necessario".format(star, len(novos)))
+            estado.update(star, vistos, arcfiles = escolhidos)
+        except Exception as erro:
+            erros.append((star, erro))
+        finally:
+            # o que ja foi sincronizado nao e refeito se a execucao parar
+            estado.save()
+
+    return erros
+
+
+# etapas do processamento de cada estrela. Cada etapa recebe o dict
+# da estrela da etapa anterior. Etapas ja registradas no manifest nao
+# sao refeitas.
+
+def etapa_coordenadas(item):
 
-        print("\n*** {} ***\n".format(star))
+    '''
+    Coordenadas da estrela (do indice, resolvido em lote em main, ou do Simbad)
+    '''
 
-        # buscando espectros antes e depois do upgrade do HARPS
-        files_before = busca_espectros_before(star)
-        files_after = busca_espectros_after(star)
+    item['plano'] = item['manifest'].get(item['star'], 'plan')
 
-        # se nao tiver espectros ANTES, baixo apenas os DEPOIS, e vice-versa
+    if item['plano'] is None:
+        item['position'] = eq.position(item['star'])
 
-        if len(files_after) == 0:
+    return item
 
-            # calculando SNR e numero de espectros a baixar
-            SNR_before, nspec_before = calcula_SNR_nspec(files_before)
-            print("\nBaixando apenas espectros ANTES do upgrade\n")
-            baixar_antes(parent_path, star, SNR_before, nspec_before, files_before)
 
-        elif len(files_before) == 0:
+def etapa_busca(item):
 
-            # calculando SNR e numero de espectros a baixar
-            SNR_after, nspec_after = calcula_SNR_nspec(files_after)
-            print("\nBaixando apenas espectros DEPOIS do upgrade\n")
-            baixar_depois(parent_path, star, SNR_after, nspec_after, files_after)
+    '''
+    Espectros da estrela no arquivo do ESO
+    '''
 
+    if item['plano'] is None:
+        item['search'] = eq.querySurveys(item['star'], instrument = 'HARPS')
+        item['manifest'].mark(item['star'], 'query', rows = len(item['search']))
 
-        # se tiver espectros ANTES E DEPOIS, verifico se tem SNR > 400 em ambos os casos
-        # se ambos forem SNR < 400, baixo ANTES E DEPOIS
-        # se algum for SNR > 400, baixo apenas ele
+    return item
 
+
+def etapa_plano(item):
+
+    '''
+    Escolhe os espectros a baixar (antes/depois do upgrade)
+    '''
+
+    if item['plano'] is None:
+        print("\n*** {} ***\n".format(item['star']))
+        search = item.pop('search')
+        if item.get('estado') is not None:
+            item['estado'].update(item['star'], search)
+        files_before, files_after = separa_epocas(search, item.pop('position'))
+        if USE_PLANNER:
+            item['plano'] = planeja_custo(files_before, files_after)
         else:
-            # calculando SNR e numero de espectros a baixar
-            SNR_before, nspec_before = calcula_SNR_nspec(files_before)
-            SNR_after, nspec_after = calcula_SNR_nspec(files_after)
-
-            # se espectros ANTES ou DEPOIS atingiram SNR = 400, baixo so eles. Se não, baixo antes E depois
-            if SNR_before >= 400:
-                # baixo o que tiver SNR maior
-                if SNR_before > SNR_after:
-                    print("\nBaixando apenas espectros ANTES do upgrade\n")
-                    baixar_antes(parent_path, star, SNR_before, nspec_before, files_before)
-                else:
-                    print("\nBaixando apenas espectros DEPOIS do upgrade\n")
-                    baixar_depois(parent_path, star, SNR_after, nspec_after, files_after)
-             
-            elif SNR_after >= 400:
-                print("\nBaixando apenas espectros DEPOIS do upgrade\n")
-                baixar_depois(parent_path, star, SNR_after, nspec_after, files_after)
+            item['plano'] = planeja(files_before, files_after)
+        item['manifest'].mark(item['star'], 'plan', **item['plano'])
 
-            else:
-                print("Baixando espectros ANTES e DEPOIS do upgrade")
-                baixar_antes(parent_path, star, SNR_before, nspec_before, files_before)
-                baixar_depois(parent_path, star, SNR_after, nspec_after, files_after)
+    return item
+
+
+def etapa_download(item):
+
+    '''
+    Baixa os espectros escolhidos
+    '''
+
+    for epoca in item['plano']:
+        if not item['manifest'].done(item['star'], 'info', epoca):
+            baixar_epoca(item['parent_path'], item['star'], epoca, item['plano'][epoca], 
+                         item['manifest'], item.get('extrator'), item.get('catalogo'))
+
+    return item
+
+
+def etapa_tamanhos(item):
+
+    '''
+    Modo DRY_RUN: obtem no datalink o tamanho dos espectros escolhidos
+    que ainda nao foram baixados (nem estao no store), sem baixar nada
+    '''
+
+    feitos = item['manifest'].items(item['star'], 'download')
 
-        # para apitar quando acabar cada estrela
-        duration = 0.4 #sec
-        freq = 600 #Hz
-        os.system('play -nq -t alsa synth {} sine {}'.format(duration, freq))
+    for epoca in item['plano']:
+        faltam = [a for a in item['plano'][epoca]['ARCFILE'] if a not in feitos
+                  and (eq.store is None or eq.store.get(a) is None)]
+        item['report'].add(item['star'], epoca, eq.fileSizes(faltam))
+
+    return item
+
+
+def etapa_info(item):
+
+    '''
+    Escreve os info_spectra.txt e marca a estrela como concluida
+    '''
+
+    for epoca in item['plano']:
+        if not item['manifest'].done(item['star'], 'info', epoca):
+            escreve_info(item['parent_path'], item['star'], epoca, item['plano'][epoca], 
+                         item['manifest'], item.get('catalogo'))
+
+    item['manifest'].mark(item['star'], 'done')
+    print("{} concluida".format(item['star']))
+
+    # para apitar quando acabar cada estrela, sem esperar o som terminar
+    duration = 0.4 #sec
+    freq = 600 #Hz
+    try:
+        subprocess.Popen(['play', '-nq', '-t', 'alsa', 'synth', str(duration), 'sine', str(freq)],
+                         stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    except OSError:
+        pass
+
+    return item
+
+
+# SNR desejado para a soma dos espectros de cada estrela
+SNR_ALVO = 1000
+
+# True: escolhe os espectros pelo menor volume de download (planeja_custo)
+# False: escolhe ANTES/DEPOIS pelos limites de SNR 400 (planeja)
+USE_PLANNER = False
+
+# True: os resultados das buscas viram arrays estruturados so com as
+# colunas usadas (eso_down.columnar), ordenados e fatiados sem copias
+# das tabelas completas do arquivo
+COLUNAR = True
+
+# True: busca a amostra inteira em poucas consultas TAP (eq.queryBulk)
+# em vez de uma consulta query_surveys por estrela
+BUSCA_EM_LOTE = False
+
+# True: para as estrelas ja concluidas, busca apenas as observacoes novas
+# desde a ultima execucao e baixa so os espectros que aumentam o SNR
+# (estado em <parent_path>/sync.json)
+SINCRONIZA = False
+
+# True: apenas busca, planeja e mostra quantos arquivos/bytes seriam
+# baixados e o tempo estimado, sem baixar nada e sem mudar o manifest.jsonl
+# e o sync.json da proxima execucao
+DRY_RUN = False
+
+# velocidade de cada download (bytes/s) e tempo por arquivo (s) usados 
+# na estimativa do DRY_RUN
+BANDA = 5*1024**2
+LATENCIA = 1.
+
+# True: extrai os FITS (s1d/e2ds) de cada tar assim que ele e baixado e
+# guarda os principais headers em <parent_path>/headers.sqlite
+EXTRAI = False
+
+# True: ao final, soma os espectros extraidos de cada estrela (requer EXTRAI)
+COADICIONA = False
+
+# True: alem do catalogo (<parent_path>/catalogo.sqlite), escreve o 
+# info_spectra.txt de cada epoca ao concluir a estrela. False: os txt
+# sao gerados sob demanda com gera_info(parent_path, catalogo)
+INFO_TXT = False
+
+# numero de threads de cada etapa
+WORKERS = {'coordenadas': 4, 'busca': 4, 'plano': 1, 'download': 2, 'info': 1, 'extracao': 2}
+
+
+def main():
+
+    inicio = timer()
+
+    stars_problems = ['HIP3311', 'HIP96160']
+
+    star_names = []
+
+    amostra = np.loadtxt("amostra_Giulia.csv", delimiter=',',dtype="str", unpack=True, skiprows=1)
+
+    for s in amostra[0]:
+        s = "HIP" + s
+        star_names.append(s) # 91 estrelas
+
+    # raiz da pasta para salvar os espectros das estrelas
+    parent_path = '/home/giumartos/Desktop/Espectros'
+    os.makedirs(parent_path, exist_ok = True)
+
+    # diario da execucao: estrelas ja processadas sao puladas numa nova execucao
+    diario = os.path.join(parent_path, 'manifest.jsonl')
+    if DRY_RUN:
+        # o DRY_RUN le o diario mas escreve as buscas e planos numa copia
+        # descartavel, para nao mudar a proxima execucao de verdade
+        descartavel, copia = tempfile.mkstemp(prefix = 'manifest_dry_run_', suffix = '.jsonl')
+        os.close(descartavel)
+        if os.path.exists(diario):
+            shutil.copyfile(diario, copia)
+        diario = copia
+    manifest = RunManifest(diario)
+
+    # tempo, bytes e erros de cada etapa e de cada requisicao
+    metricas = Metrics(os.path.join(parent_path, 'metricas.jsonl'))
+    eq.metrics = metricas
+
+    # cada arquivo fica uma vez so no store, as pastas das estrelas tem links para ele
+    eq.store = SpectrumStore(os.path.join(parent_path, 'store'))
+
+    # coordenadas de toda a amostra em poucas buscas no Simbad
+    pendentes = [s for s in star_names if not manifest.done(s, 'plan')]
+    eq.coords.resolve(pendentes)
+
+    # tabelas de todas as estrelas pendentes de uma vez, usadas pela etapa de busca
+    if BUSCA_EM_LOTE:
+        eq.queryBulk(pendentes, instrument = 'HARPS')
+
+    extrator = None
+    if EXTRAI and not DRY_RUN:
+        extrator = Extractor(HeaderIndex(os.path.join(parent_path, 'headers.sqlite')), 
+                             workers = WORKERS['extracao'], metrics = metricas)
+
+    # uma linha por espectro baixado de toda a amostra (estrela, epoca, data, SNR, arquivo)
+    catalogo = SpectrumCatalog(os.path.join(parent_path, 'catalogo.sqlite'))
+
+    # ultima data e ARCFILEs vistos de cada estrela, para o modo incremental
+    estado = SyncState(os.path.join(parent_path, 'sync.json'))
+
+    itens, concluidas = [], []
+    for star in star_names:
+        if manifest.done(star, 'done'):
+            print("{} ja processada".format(star))
+            concluidas.append(star)
+        else:
+            itens.append({'star': star, 'parent_path': parent_path, 'manifest': manifest,
+                          'extrator': extrator, 'estado': None if DRY_RUN else estado,
+                          'catalogo': catalogo})
+
+    if SINCRONIZA and not DRY_RUN and len(concluidas) > 0:
+        for star, erro in sincroniza(concluidas, parent_path, manifest, estado, extrator, catalogo):
+            print("ERRO em {} (sincronizacao): {}".format(star, erro))
+
+    etapas = [('coordenadas', etapa_coordenadas, WORKERS['coordenadas']),
+              ('busca', etapa_busca, WORKERS['busca']),
+              ('plano', etapa_plano, WORKERS['plano'])]
+
+    if DRY_RUN:
+        report = TransferReport(concurrency = eq.workers, bandwidth = BANDA, latency = LATENCIA)
+        for item in itens:
+            item['report'] = report
+        etapas.append(('tamanhos', etapa_tamanhos, WORKERS['download']))
+    else:
+        etapas.append(('download', etapa_download, WORKERS['download']))
+        etapas.append(('info', etapa_info, WORKERS['info']))
+
+    # as etapas rodam ao mesmo tempo, cada uma com suas threads
+    pipeline = Pipeline(etapas, metrics = metricas)
+    pipeline.run(itens)
+
+    if DRY_RUN:
+        os.remove(diario)
+    else:
+        estado.save()
+
+    for etapa, item, erro in pipeline.errors:
+        print("ERRO em {} ({}): {}".format(item['star'], etapa, erro))
+
+    if DRY_RUN:
+        print("\n" + report.format())
+
+    if extrator is not None:
+        extraidos = extrator.wait()
+        print("{} arquivos FITS extraidos e indexados".format(len(extraidos)))
+        for tar, erro in extrator.errors:
+            print("ERRO ao extrair {}: {}".format(tar, erro))
+        extrator.close()
+
+        if COADICIONA:
+            for item in itens:
+                coadiciona(parent_path, item['star'], catalogo)
+
+    resumo = catalogo.summary()
+    print("{} espectros de {} estrelas no catalogo".format(sum(r['nspec'] for r in resumo.values()),
+                                                          len(set(s for s, e in resumo))))
+    catalogo.close()
+
+    if len(eq.no_ancillary) > 0:
+        print("{} espectros sem arquivo ancillary no arquivo do ESO (pulados)".format(len(eq.no_ancillary)))
+
+    # conexoes HTTP reaproveitadas durante toda a amostra
+    stats = eq.connection_stats()['total']
+    print("{} requisicoes em {} conexoes".format(stats['requests'], stats['connections']))
+
+    # arquivos que nao precisaram ser baixados de novo
+    stats = eq.store.stats()
+    print("{} arquivos reaproveitados do store ({:.1f} MB economizados)".format(stats['hits'], stats['bytes_saved']/1024**2))
+
+    # onde o tempo foi gasto: arquivo ESO, Simbad ou disco
+    print("\n" + metricas.format())
+    metricas.prometheus(os.path.join(parent_path, 'metricas.prom'))
+    metricas.close()
+    print("Tempo total: {:.1f} s".format(timer() - inicio))
 
     print("FINALIZADA")
 
 
-main()
\ No newline at end of file
+main()
@@ -1,2 +1,13 @@
-from . import search
-from . import angle
+import importlib
+
+#submodules are imported on first access (eso_down.search, ...), so
+#importing the package does not load what is not used
+__all__ = ['search', 'angle', 'filters', 'datalink', 'cache', 'manifest',
+           'pipeline', 'coords', 'planner', 'report', 'store', 'extract', 'coadd', 'throttle',
+           'metrics', 'tap', 'sync',
+           'columnar', 'catalog']
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.'+name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -17,3 +17,95 @@ def dec(d,m,s):
 
 
 
+def _split(values):
+    """
+    Split sexagesimal strings ('hh mm ss.s' or 'hh:mm:ss.s') in an 
+    array of shape (n, 3), missing fields are 0
+    """
+    values = values.tolist() if isinstance(values, np.ndarray) else [str(v) for v in values]
+    if len(values) == 0:
+        return np.zeros((0, 3))
+    #a ';' between the rows: if every row has three fields it is every 4th token
+    tokens = ' ; '.join(values).replace(':', ' ').split()
+    if len(tokens) == 4*len(values) - 1 and tokens[3::4].count(';') == len(values) - 1:
+        #one conversion for everything
+        del tokens[3::4]
+        return np.array(tokens, dtype=float).reshape(-1, 3)
+    parts = np.zeros((len(values), 3))
+    for i, v in enumerate(values):
+        fields = str(v).replace(':', ' ').split()[:3]
+        parts[i, :len(fields)] = [float(f) for f in fields]
+    return parts
+
+def hms2deg(values):
+    """
+    Right ascension strings ('hh mm ss.s') to degrees, for a whole array
+
+    Parameters
+    ----------
+    values: array of str
+
+    Returns
+    -------
+    deg: array of float
+    """
+    parts = _split(values)
+    return 15*(parts[:, 0] + parts[:, 1]/60 + parts[:, 2]/3600)
+
+def dms2deg(values):
+    """
+    Declination strings ('+dd mm ss.s') to degrees, for a whole array
+
+    Parameters
+    ----------
+    values: array of str
+
+    Returns
+    -------
+    deg: array of float
+    """
+    parts = _split(values)
+    #the sign of the degrees, also of '-00'
+    sign = np.where(np.signbit(parts[:, 0]), -1., 1.)
+    return sign*(np.abs(parts[:, 0]) + parts[:, 1]/60 + parts[:, 2]/3600)
+
+def separation(ra1, dec1, ra2, dec2):
+    """
+    Great-circle distance between positions, for whole arrays
+
+    Uses the haversine formula, so it is accurate for small distances
+    and does not depend on where RA wraps from 360 to 0.
+
+    Parameters
+    ----------
+    ra1, dec1, ra2, dec2: float or array
+        Coordinates in degrees
+
+    Returns
+    -------
+    sep: float or array
+        Distance in degrees
+    """
+    ra1, dec1 = np.radians(ra1), np.radians(dec1)
+    ra2, dec2 = np.radians(ra2), np.radians(dec2)
+    h = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+
+def cone(ra, dec, ra0, dec0, radius):
+    """
+    Which positions are within radius of (ra0, dec0)
+
+    Parameters
+    ----------
+    ra, dec: array
+        Coordinates in degrees
+    ra0, dec0: float
+        Center of the cone in degrees
+    radius: float
+        Radius of the cone in arcsec
+
+    Returns
+    -------
+    inside: array of bool
+    """
+    return separation(ra, dec, ra0, dec0) <= radius/3600
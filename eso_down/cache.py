@@ -0,0 +1,146 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+class CacheMiss(KeyError):
+    """
+    Raised in offline mode when a query is not in the cache
+    """
+
+class Cache:
+    """
+    Persistent cache of query results in a SQLite file
+
+    Parameters
+    ----------
+    path: str
+        Adress of the SQLite file
+    ttl: float
+        Optional, time (in seconds) an entry stays valid
+        Default: ttl = 7 days. If None: never expires
+    max_bytes: int
+        Optional, maximum size of the stored values. The least recently
+        used entries are removed above it
+        Default: max_bytes = 500 MB
+    offline: bool
+        Optional, only serve from the cache (CacheMiss when missing)
+        Default: offline = False
+    """
+    def __init__(self, path, ttl=7*86400, max_bytes=500*1024**2, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                         'created REAL, accessed REAL)')
+        self._db.commit()
+
+    def _key(self, key):
+        return json.dumps(key, default=str)
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """
+        Value stored for key
+
+        Raises
+        ------
+        KeyError
+            If key is not stored or expired (expired entries are kept in
+            offline mode)
+        """
+        k = self._key(key)
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM entries WHERE key = ?',
+                                   (k,)).fetchone()
+            if row is None or (self._expired(row[1]) and not self.offline):
+                raise KeyError(key)
+            self._db.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                             (time.time(), k))
+            self._db.commit()
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Store value for key and evict old entries if needed
+        """
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                             (self._key(key), blob, len(blob), now, now))
+            self._db.commit()
+        self.evict()
+
+    def fetch(self, key, function):
+        """
+        Value stored for key, or the result of function() (which is stored)
+
+        Raises
+        ------
+        CacheMiss
+            In offline mode, if key is not stored
+        """
+        try:
+            value = self.get(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+            if self.offline:
+                raise CacheMiss(key)
+        value = function()
+        self.set(key, value)
+        return value
+
+    def evict(self):
+        """
+        Remove the expired entries and the least recently used ones
+        above max_bytes
+
+        Returns
+        -------
+        removed: int
+            Number of removed entries
+        """
+        removed = 0
+        with self._lock:
+            if self.ttl is not None and not self.offline:
+                cur = self._db.execute('DELETE FROM entries WHERE created < ?',
+                                       (time.time() - self.ttl,))
+                removed += cur.rowcount
+            if self.max_bytes is not None:
+                total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self._db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall()
+                    for k, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        self._db.execute('DELETE FROM entries WHERE key = ?', (k,))
+                        total -= size
+                        removed += 1
+            self._db.commit()
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM entries')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+COLUMNS = ['star', 'epoch', 'arcfile', 'date_obs', 'snr', 'path', 'bytes', 'downloaded']
+
+class SpectrumCatalog:
+    """
+    Append-only SQLite catalog of the downloaded spectra, one row for
+    each file, shared by the whole sample
+
+    The rows are kept in memory and written in batches, each batch in
+    one transaction (WAL journal, so an interrupted run loses at most
+    the rows not flushed yet and never corrupts the file). A spectrum
+    already in the catalog is not written again.
+
+    Parameters
+    ----------
+    path: str
+        Adress of the SQLite file
+    batch: int
+        Optional, number of rows written at a time
+        Default: batch = 50
+    """
+    def __init__(self, path, batch=50):
+        self.path = path
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._pending = []
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spectra (star TEXT, epoch TEXT, arcfile TEXT, '
+                         'date_obs TEXT, snr REAL, path TEXT, bytes INTEGER, downloaded REAL, '
+                         'PRIMARY KEY (star, epoch, arcfile))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS spectra_arcfile ON spectra (arcfile)')
+        self._db.commit()
+
+    def add(self, star, epoch, arcfile, date_obs=None, snr=None, path=None, nbytes=None, downloaded=None):
+        """
+        Queue one downloaded spectrum (written when the batch is full)
+
+        Parameters
+        ----------
+        star, epoch, arcfile: str
+        date_obs: str
+            Optional, 'Date Obs' of the archive
+        snr: float
+            Optional, 'SNR (spectra)' of the archive
+        path: str
+            Optional, adress of the downloaded file
+        nbytes: int
+            Optional, size of the file (Default: read from path)
+        downloaded: float
+            Optional, time of the download (Default: now)
+        """
+        if nbytes is None and path is not None and os.path.exists(path):
+            nbytes = os.path.getsize(path)
+        row = (str(star), str(epoch), str(arcfile), None if date_obs is None else str(date_obs),
+               None if snr is None else float(snr), path, nbytes,
+               time.time() if downloaded is None else downloaded)
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.batch:
+                self._write()
+
+    def _write(self):
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO spectra VALUES ({})'.format(
+                ', '.join('?'*len(COLUMNS))), self._pending)
+        self._pending = []
+
+    def flush(self):
+        """
+        Write the queued rows
+        """
+        with self._lock:
+            self._write()
+
+    def rows(self, star=None, epoch=None):
+        """
+        Spectra of a star (or of the whole sample), ordered by SNR
+
+        Parameters
+        ----------
+        star: str
+            Optional, Default: all the stars
+        epoch: str
+            Optional, Default: all the epochs
+
+        Returns
+        -------
+        rows: list of dict
+        """
+        where, params = [], []
+        if star is not None:
+            where.append('star = ?')
+            params.append(str(star))
+        if epoch is not None:
+            where.append('epoch = ?')
+            params.append(str(epoch))
+        return self.query(' AND '.join(where), params)
+
+    def query(self, where='', params=()):
+        """
+        Rows as dicts, e.g. query('snr > ?', (100,)), ordered by star,
+        epoch and SNR (highest first). The queued rows are written first
+        """
+        sql = 'SELECT * FROM spectra'
+        if where:
+            sql += ' WHERE '+where
+        sql += ' ORDER BY star, epoch, snr DESC'
+        with self._lock:
+            self._write()
+            cur = self._db.execute(sql, params)
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    def summary(self, star=None):
+        """
+        Number of spectra, SNR reached (sqrt of the sum of SNR**2) and
+        bytes of each star and epoch
+
+        Returns
+        -------
+        summary: dict
+            (star, epoch) -> {'nspec', 'SNR_total', 'bytes'}
+        """
+        sql = ('SELECT star, epoch, COUNT(*), SUM(snr*snr), COALESCE(SUM(bytes), 0) '
+               'FROM spectra {} GROUP BY star, epoch')
+        params = () if star is None else (str(star),)
+        with self._lock:
+            self._write()
+            cur = self._db.execute(sql.format('' if star is None else 'WHERE star = ?'), params)
+            return {(s, e): {'nspec': n, 'SNR_total': float(np.sqrt(snr2 or 0.)), 'bytes': b}
+                    for s, e, n, snr2, b in cur.fetchall()}
+
+    def write_info(self, out_file, star, epoch):
+        """
+        Write the info_spectra.txt of a star and epoch from the catalog,
+        in the format of download_espectros_ESO.write_out_file
+
+        Returns
+        -------
+        nspec: int
+            Number of spectra written (nothing is written if 0)
+        """
+        rows = self.rows(star, epoch)
+        if not rows:
+            return 0
+        snr = np.array([r['snr'] if r['snr'] is not None else np.nan for r in rows], dtype=float)
+        dates = np.array([r['date_obs'] or '' for r in rows])
+        head = "SNRtotal = {:.2f}\n{} spectra downloaded\nDates   SNR".format(
+            np.sqrt(np.nansum(snr**2)), len(rows))
+        parte = out_file+'.part'
+        np.savetxt(parte, np.array([dates, snr]).T, header=head, delimiter='   ', fmt='%s')
+        os.replace(parte, out_file)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._write()
+            self._db.close()
@@ -0,0 +1,202 @@
+import glob
+import os
+import numpy as np
+
+#header keywords with the SNR of the spectrum (first one found is used)
+SNR_KEYWORDS = ['HIERARCH ESO DRS SPE EXT SN50', 'SNR']
+
+def _header_snr(header):
+    for key in SNR_KEYWORDS:
+        if key in header:
+            return float(header[key])
+    return np.nan
+
+def read_spectrum(path):
+    """
+    Wavelength, flux and SNR of a 1D spectrum, with the data memory-mapped
+
+    Accepts the HARPS s1d images (linear wavelength from CRVAL1/CDELT1)
+    and the phase 3 binary tables with WAVE and FLUX columns
+
+    Parameters
+    ----------
+    path: str
+        Adress of the FITS file
+
+    Returns
+    -------
+    wave, flux: array
+        Wavelength and flux (the flux is a view of the memory-mapped file)
+    snr: float
+        SNR of the header (nan if not there)
+    """
+    from astropy.io import fits
+    hdul = fits.open(path, memmap=True)
+    header = hdul[0].header
+    if hdul[0].data is not None:
+        flux = hdul[0].data
+        pix = np.arange(len(flux), dtype=float)
+        wave = header['CRVAL1'] + (pix + 1 - header.get('CRPIX1', 1.))*header['CDELT1']
+    else:
+        data = hdul[1].data
+        names = [n.upper() for n in data.columns.names]
+        wave = np.ravel(data.field(names.index('WAVE'))[0])
+        flux = np.ravel(data.field(names.index('FLUX'))[0])
+    return np.asarray(wave, dtype=float), flux, _header_snr(header)
+
+def common_grid(paths, step=None):
+    """
+    Wavelength grid covered by all the spectra
+
+    Parameters
+    ----------
+    paths: list of str
+        Adresses of the spectra
+    step: float
+        Optional, step of the grid
+        Default: step = largest median step of the spectra
+
+    Returns
+    -------
+    grid: array
+    """
+    lo, hi, steps = -np.inf, np.inf, []
+    for path in paths:
+        wave = read_spectrum(path)[0]
+        lo, hi = max(lo, wave[0]), min(hi, wave[-1])
+        steps.append(np.median(np.diff(wave)))
+    if step is None:
+        step = max(steps)
+    if not hi > lo:
+        raise ValueError("The spectra do not have a common wavelength range")
+    return np.arange(lo, hi, step)
+
+def der_snr(flux):
+    """
+    SNR measured from the flux itself (DER_SNR, Stoehr et al. 2008)
+    """
+    flux = np.asarray(flux, dtype=float)
+    flux = flux[np.isfinite(flux)]
+    if len(flux) < 5:
+        return np.nan
+    noise = 0.6052697*np.median(np.abs(2*flux[2:-2] - flux[:-4] - flux[4:]))
+    return float(np.median(flux)/noise) if noise > 0 else np.inf
+
+def coadd(paths, grid=None, weights=None, chunk=200000):
+    """
+    SNR**2 weighted stack of spectra on a common wavelength grid
+
+    Each spectrum is normalized by its median, resampled on the grid
+    (linear interpolation) and added to two accumulators of the size of
+    the grid. The grid is processed in chunks and the spectra are
+    memory-mapped, so the memory does not grow with the number of
+    spectra.
+
+    Parameters
+    ----------
+    paths: list of str
+        Adresses of the spectra
+    grid: array
+        Optional, wavelength grid
+        Default: common_grid(paths)
+    weights: array
+        Optional, weight of each spectrum
+        Default: SNR**2 of the headers (1 when missing)
+    chunk: int
+        Optional, number of grid points processed at a time
+        Default: chunk = 200000
+
+    Returns
+    -------
+    result: dict
+        'wave', 'flux' (normalized stack), 'nspec',
+        'SNR_expected' (sqrt of the sum of SNR**2 of the headers) and
+        'SNR_measured' (DER_SNR of the stack)
+    """
+    if grid is None:
+        grid = common_grid(paths)
+    total = np.zeros(len(grid))
+    norm = np.zeros(len(grid))
+    snrs = []
+    for i, path in enumerate(paths):
+        wave, flux, snr = read_spectrum(path)
+        snrs.append(snr)
+        if weights is not None:
+            w = float(weights[i])
+        else:
+            w = snr**2 if np.isfinite(snr) else 1.
+        scale = np.nanmedian(flux)
+        if not np.isfinite(scale) or scale == 0:
+            scale = 1.
+        for start in range(0, len(grid), chunk):
+            g = grid[start:start+chunk]
+            #only the part of the spectrum under this chunk is read
+            a = max(np.searchsorted(wave, g[0]) - 1, 0)
+            b = min(np.searchsorted(wave, g[-1]) + 1, len(wave))
+            f = np.interp(g, wave[a:b], np.asarray(flux[a:b], dtype=float)/scale,
+                          left=np.nan, right=np.nan)
+            ok = np.isfinite(f)
+            total[start:start+chunk][ok] += w*f[ok]
+            norm[start:start+chunk][ok] += w
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stack = total/norm
+    snrs = np.asarray(snrs, dtype=float)
+    return {'wave': grid, 'flux': stack, 'nspec': len(paths),
+            'SNR_expected': float(np.sqrt(np.nansum(snrs**2))),
+            'SNR_measured': der_snr(stack)}
+
+def planned_snr(info_file):
+    """
+    SNRtotal written by the driver in info_spectra.txt (nan if not found)
+    """
+    if not os.path.exists(info_file):
+        return np.nan
+    with open(info_file) as f:
+        for line in f:
+            if 'SNRtotal' in line:
+                return float(line.split('=')[1])
+    return np.nan
+
+def coadd_folder(folder, pattern='*s1d*.fits', output=None):
+    """
+    Co-add the spectra of a <star>/Before or <star>/After folder
+
+    Parameters
+    ----------
+    folder: str
+        Folder with the extracted spectra and info_spectra.txt
+    pattern: str
+        Optional, shell pattern of the spectra to add
+        Default: pattern = '*s1d*.fits'
+    output: str
+        Optional, adress of a FITS file where the stack is written
+        (left out of the spectra if it matches pattern)
+
+    Returns
+    -------
+    result: dict
+        Same as coadd, plus 'SNR_planned' from info_spectra.txt
+    """
+    paths = sorted(glob.glob(os.path.join(folder, pattern)))
+    if output:
+        #a stack of an earlier run is not one of the spectra
+        paths = [p for p in paths if os.path.abspath(p) != os.path.abspath(output)]
+    if len(paths) == 0:
+        raise ValueError("No spectra matching {} in {}".format(pattern, folder))
+    result = coadd(paths)
+    result['SNR_planned'] = planned_snr(os.path.join(folder, 'info_spectra.txt'))
+    if output:
+        from astropy.io import fits
+        #one row with array columns, as the phase 3 spectra (read_spectrum reads it back)
+        n = len(result['wave'])
+        cols = [fits.Column(name='WAVE', format='{}D'.format(n), array=result['wave'][None, :]),
+                fits.Column(name='FLUX', format='{}D'.format(n), array=result['flux'][None, :])]
+        primary = fits.PrimaryHDU()
+        primary.header['NSPEC'] = result['nspec']
+        #FITS headers do not take nan/inf
+        for key, value in (('SNREXP', result['SNR_expected']), ('SNRMEAS', result['SNR_measured']),
+                           ('SNR', result['SNR_measured'])):
+            if np.isfinite(value):
+                primary.header[key] = value
+        fits.HDUList([primary, fits.BinTableHDU.from_columns(cols)]).writeto(output, overwrite=True)
+    return result
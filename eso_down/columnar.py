@@ -0,0 +1,76 @@
+import numpy as np
+
+#columns used by the search, planning and download (names of query_surveys)
+COLUMNS = ['ARCFILE', 'Date Obs', 'SNR (spectra)', 'RA', 'DEC', 'R (&lambda;/&delta;&lambda;)']
+
+def colnames(table):
+    """
+    Column names of an astropy table or of a structured array
+    """
+    if isinstance(table, np.ndarray):
+        return list(table.dtype.names or ())
+    return list(table.colnames)
+
+def to_columnar(table, columns=None):
+    """
+    Slim copy of a table with only the needed columns, as a NumPy
+    structured array
+
+    The array keeps the column names, so table['SNR (spectra)'],
+    table[mask] and table[:n] work as before, but the rows only hold the
+    used columns and a slice table[:n] is a view, not a copy.
+
+    Parameters
+    ----------
+    table: table
+        Astropy table (or structured array) with the archive result
+    columns: list of str
+        Optional, columns to keep (the missing ones are left out)
+        Default: COLUMNS
+
+    Returns
+    -------
+    array: structured array
+    """
+    if columns is None:
+        columns = COLUMNS
+    names = colnames(table)
+    data, dtype = [], []
+    for name in columns:
+        if name not in names:
+            continue
+        column = table[name]
+        if np.ma.is_masked(column):
+            #only masked columns are filled, the others are used as views
+            column = np.ma.asarray(column)
+            if column.dtype.kind in 'iub':
+                column = column.astype(float)
+            values = column.filled(np.nan if column.dtype.kind in 'fc' else '')
+        else:
+            values = np.asarray(column)
+        data.append(values)
+        dtype.append((name, values.dtype))
+    array = np.empty(len(table), dtype=dtype)
+    for (name, _), values in zip(dtype, data):
+        array[name] = values
+    return array
+
+def sort(table, column, reverse=False):
+    """
+    Table sorted by a column
+
+    An astropy table is sorted in place (as table.sort) and returned, a
+    structured array is reordered with one argsort of the column (only
+    the slim rows are copied)
+
+    Returns
+    -------
+    table: table or structured array
+    """
+    if not isinstance(table, np.ndarray):
+        table.sort(column, reverse=reverse)
+        return table
+    order = np.argsort(table[column], kind='stable')
+    if reverse:
+        order = order[::-1]
+    return table[order]
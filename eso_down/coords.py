@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+import numpy as np
+import eso_down.angle as tt
+from eso_down.metrics import measure
+
+def from_simbad(table):
+    """
+    RA and DEC (degrees) of every row of a Simbad query
+
+    Accepts the sexagesimal 'RA'/'DEC' string columns or the 'ra'/'dec'
+    columns in degrees of the newer Simbad service
+
+    Parameters
+    ----------
+    table: table
+        Result of Simbad.query_object or Simbad.query_objects
+
+    Returns
+    -------
+    ra, dec: array of float
+        Coordinates in degrees (nan for objects not found)
+    """
+    n = len(table)
+    if n == 0:
+        return np.zeros(0), np.zeros(0)
+    if 'RA' in table.colnames:
+        ra_str = np.asarray(np.ma.filled(np.ma.asarray(table['RA']), ''), dtype=str)
+        dec_str = np.asarray(np.ma.filled(np.ma.asarray(table['DEC']), ''), dtype=str)
+        found = np.char.str_len(np.char.strip(ra_str)) > 0
+        ra, dec = np.full(n, np.nan), np.full(n, np.nan)
+        ra[found] = tt.hms2deg(ra_str[found])
+        dec[found] = tt.dms2deg(dec_str[found])
+        return ra, dec
+    ra = np.ma.filled(np.ma.asarray(table['ra'], dtype=float), np.nan)
+    dec = np.ma.filled(np.ma.asarray(table['dec'], dtype=float), np.nan)
+    return np.asarray(ra), np.asarray(dec)
+
+def _key(name):
+    return ' '.join(str(name).split()).upper()
+
+def match_rows(table, names):
+    """
+    Row of a Simbad query_objects result that belongs to each name
+
+    The rows are matched on 'user_specified_id' (or 'object_number_id')
+    of the newer Simbad service, whose row order is not guaranteed, and
+    on 'TYPED_ID' of the older one. Only a table without any of these
+    columns is matched by position.
+
+    Parameters
+    ----------
+    table: table
+        Result of Simbad.query_objects(names)
+    names: list of str
+        Names of the query
+
+    Returns
+    -------
+    rows: array of int
+        Row of each name (-1 if not in the table), or None if the rows
+        can not be matched
+    """
+    if 'user_specified_id' in table.colnames or 'TYPED_ID' in table.colnames:
+        column = 'user_specified_id' if 'user_specified_id' in table.colnames else 'TYPED_ID'
+        ids = np.ma.filled(np.ma.asarray(table[column]), '')
+        index = {}
+        for row, value in enumerate(ids):
+            if isinstance(value, bytes):
+                value = value.decode()
+            index.setdefault(_key(value), row)
+        return np.array([index.get(_key(name), -1) for name in names], dtype=int)
+    if 'object_number_id' in table.colnames:
+        #1 for the first name of the query
+        number = np.ma.filled(np.ma.asarray(table['object_number_id'], dtype=int), 0)
+        rows = np.full(len(names), -1, dtype=int)
+        for row in range(len(number) - 1, -1, -1):
+            if 1 <= number[row] <= len(names):
+                rows[number[row] - 1] = row
+        return rows
+    if len(table) == len(names):
+        return np.arange(len(names))
+    return None
+
+class CoordinateIndex:
+    """
+    Coordinates of the stars, resolved in Simbad in batches
+
+    Parameters
+    ----------
+    path: str
+        Optional, adress of a JSON file where the index is kept between runs
+        Default: path = None (only in memory)
+    batch: int
+        Optional, number of names in each Simbad query
+        Default: batch = 100
+    simbad: object
+        Optional, Simbad service (anything with query_objects and query_object)
+        Default: astroquery Simbad
+    scheduler: RequestScheduler
+        Optional, rate limits and retries of the Simbad queries
+        (eso_down.throttle.RequestScheduler)
+        Default: scheduler = None (queries sent directly)
+    metrics: Metrics
+        Optional, timing of the Simbad queries, as stage 'simbad'
+        (eso_down.metrics.Metrics)
+        Default: metrics = None (nothing recorded)
+    """
+    def __init__(self, path=None, batch=100, simbad=None, scheduler=None, metrics=None):
+        self.path = path
+        self.batch = batch
+        self._simbad = simbad
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self.index = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.index = {k: tuple(v) for k, v in json.load(f).items()}
+
+    @property
+    def simbad(self):
+        if self._simbad is None:
+            from astroquery.simbad import Simbad
+            self._simbad = Simbad
+        return self._simbad
+
+    def _call(self, function, *args, **fields):
+        with measure(self.metrics, 'simbad', **fields):
+            if self.scheduler is None:
+                return function(*args)
+            return self.scheduler.call('simbad', function, *args)
+
+    def __contains__(self, star):
+        return star in self.index
+
+    def get(self, star):
+        """
+        (ra, dec) in degrees of a star already in the index, or None
+        """
+        return self.index.get(star)
+
+    def add(self, star, ra, dec):
+        """
+        Store the coordinates (degrees) of a star
+        """
+        with self._lock:
+            self.index[star] = (float(ra), float(dec))
+
+    def save(self):
+        """
+        Write the index to its JSON file (if it has one)
+        """
+        if not self.path:
+            return
+        with self._lock:
+            parte = self.path+'.part'
+            with open(parte, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(parte, self.path)
+
+    def resolve(self, stars):
+        """
+        Coordinates of the stars, querying Simbad only for the ones that
+        are not in the index yet
+
+        Parameters
+        ----------
+        stars: list of str
+            Names of the stars
+
+        Returns
+        -------
+        ra, dec: array of float
+            Coordinates in degrees, in the order of stars (nan if not found)
+        """
+        stars = [str(s) for s in stars]
+        missing = list(dict.fromkeys(s for s in stars if s not in self.index))
+        for i in range(0, len(missing), self.batch):
+            names = missing[i:i+self.batch]
+            table = self._call(self.simbad.query_objects, names, stars=len(names))
+            rows = None if table is None else match_rows(table, names)
+            if rows is None:
+                #without a way to match the rows to the names, one query for each name
+                for name in names:
+                    table = self._call(self.simbad.query_object, name, star=name)
+                    if table is not None and len(table) > 0:
+                        ra, dec = from_simbad(table[:1])
+                        if np.isfinite(ra[0]):
+                            self.add(name, ra[0], dec[0])
+                continue
+            ra, dec = from_simbad(table)
+            for name, row in zip(names, rows):
+                if row >= 0 and np.isfinite(ra[row]):
+                    self.add(name, ra[row], dec[row])
+        if missing:
+            self.save()
+        coords = np.array([self.index.get(s, (np.nan, np.nan)) for s in stars], dtype=float)
+        coords = coords.reshape(-1, 2)
+        return coords[:, 0], coords[:, 1]
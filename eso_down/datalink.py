@@ -0,0 +1,103 @@
+import json
+import os
+from urllib.parse import urlparse
+
+#prefix of the ESO identifiers used by the datalink service
+IVO_PREFIX = 'ivo://eso.org/ID?'
+
+def ivo_id(arcfile):
+    """
+    Datalink identifier of an ARCFILE
+    """
+    return IVO_PREFIX+str(arcfile)
+
+def arcfile(ID):
+    """
+    ARCFILE of a datalink identifier
+    """
+    ID = str(ID)
+    if ID.startswith(IVO_PREFIX):
+        return ID[len(IVO_PREFIX):]
+    return ID
+
+def parse(payload):
+    """
+    Rows of a datalink response in JSON
+
+    Accepts the table as {"fields": [...], "data": [[...], ...]} (DALI),
+    as a list of objects, or as {"data": [objects]}
+
+    Parameters
+    ----------
+    payload: bytes, str or dict
+        Response of the service
+
+    Returns
+    -------
+    rows: list of dict
+        One dict for each link, with the column names as keys
+    """
+    if isinstance(payload, (bytes, str)):
+        payload = json.loads(payload)
+    if isinstance(payload, dict):
+        data = payload.get('data', [])
+        fields = payload.get('fields') or payload.get('columns')
+    else:
+        data, fields = payload, None
+    if fields:
+        names = [f['name'] if isinstance(f, dict) else str(f) for f in fields]
+        return [dict(zip(names, row)) for row in data]
+    return [dict(row) for row in data]
+
+def _is_ancillary(row):
+    """
+    Whether a datalink row points to the ancillary tar of the spectrum
+    """
+    if row.get('error_message') or not row.get('access_url'):
+        return False
+    semantics = str(row.get('semantics', '')).lower()
+    description = str(row.get('description', '')).lower()
+    return 'auxiliary' in semantics or 'ancillary' in description
+
+def _rank(row):
+    """
+    Preference of a candidate link (tar files first)
+    """
+    content_type = str(row.get('content_type', '')).lower()
+    return 0 if 'tar' in content_type else 1
+
+def file_name(url):
+    """
+    Name of the file in the data portal, taken from the access url
+    """
+    return os.path.basename(urlparse(url).path)
+
+def ancillary(rows):
+    """
+    Ancillary link of each identifier in the datalink rows
+
+    Parameters
+    ----------
+    rows: list of dict
+        Rows returned by parse
+
+    Returns
+    -------
+    links: dict
+        ARCFILE -> dict with access_url, name, content_type and
+        content_length (None if unknown) of the ancillary file
+    """
+    links = {}
+    for row in rows:
+        if not _is_ancillary(row):
+            continue
+        arc = arcfile(row.get('ID', ''))
+        if arc in links and _rank(links[arc]) <= _rank(row):
+            continue
+        size = row.get('content_length')
+        links[arc] = {'arcfile': arc,
+                      'access_url': row['access_url'],
+                      'name': file_name(row['access_url']),
+                      'content_type': row.get('content_type'),
+                      'content_length': int(size) if size not in (None, '') else None}
+    return links
@@ -0,0 +1,188 @@
+import fnmatch
+import os
+import shutil
+import sqlite3
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from eso_down.metrics import measure
+
+#members of the ancillary tar that are extracted
+PATTERNS = ['*s1d*.fits', '*e2ds*.fits']
+
+#header keywords of each column of the index (first one found is used)
+KEYWORDS = {'object': ['OBJECT'],
+            'date_obs': ['DATE-OBS'],
+            'mjd_obs': ['MJD-OBS'],
+            'exptime': ['EXPTIME'],
+            'snr': ['HIERARCH ESO DRS SPE EXT SN50', 'SNR'],
+            'berv': ['HIERARCH ESO DRS BERV'],
+            'rv': ['HIERARCH ESO DRS CCF RVC', 'HIERARCH ESO DRS CCF RV']}
+
+def extract(tar_path, dest, patterns=None):
+    """
+    Extract from a tar only the members that match the patterns
+
+    The tar is read as a stream (no index of the members, no seek), and
+    the members are written directly to dest without their folders.
+
+    Parameters
+    ----------
+    tar_path: str
+        Adress of the tar
+    dest: str
+        Folder where the members are written
+    patterns: list of str
+        Optional, shell patterns of the names of the wanted members
+        Default: PATTERNS
+
+    Returns
+    -------
+    files: list of str
+        Adresses of the extracted files
+    """
+    if patterns is None:
+        patterns = PATTERNS
+    os.makedirs(dest, exist_ok=True)
+    files = []
+    with tarfile.open(tar_path, mode='r|*') as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile() or not any(fnmatch.fnmatch(name, p) for p in patterns):
+                continue
+            path = os.path.join(dest, name)
+            with tar.extractfile(member) as src, open(path+'.part', 'wb') as out:
+                shutil.copyfileobj(src, out, 1024*1024)
+            os.replace(path+'.part', path)
+            files.append(path)
+    return files
+
+def read_header(path):
+    """
+    Main keywords of the primary header of a FITS file
+
+    Returns
+    -------
+    values: dict
+        One value for each column of KEYWORDS (None if not in the header)
+    """
+    from astropy.io import fits
+    header = fits.getheader(path, 0)
+    values = {}
+    for column, keys in KEYWORDS.items():
+        values[column] = None
+        for key in keys:
+            if key in header:
+                values[column] = header[key]
+                break
+    return values
+
+class HeaderIndex:
+    """
+    SQLite index with the main header keywords of the extracted spectra
+
+    Parameters
+    ----------
+    path: str
+        Adress of the SQLite file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        columns = ', '.join('{} {}'.format(c, 'TEXT' if c in ('object', 'date_obs') else 'REAL')
+                            for c in KEYWORDS)
+        self._db.execute('CREATE TABLE IF NOT EXISTS headers (file TEXT PRIMARY KEY, '
+                         'tar TEXT, arcfile TEXT, {})'.format(columns))
+        self._db.commit()
+
+    def add(self, file, tar=None, arcfile=None, values=None):
+        """
+        Store the keywords of one file (read from it if values is None)
+        """
+        if values is None:
+            values = read_header(file)
+        columns = ['file', 'tar', 'arcfile'] + list(KEYWORDS)
+        row = [file, tar, arcfile] + [values.get(c) for c in KEYWORDS]
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO headers ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join('?'*len(columns))), row)
+            self._db.commit()
+
+    def query(self, where='', params=()):
+        """
+        Rows of the index as dicts, e.g. query('arcfile = ?', (arcfile,))
+        """
+        sql = 'SELECT * FROM headers'
+        if where:
+            sql += ' WHERE '+where
+        with self._lock:
+            cur = self._db.execute(sql, params)
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+
+class Extractor:
+    """
+    Pool of workers that extract and index the tars while others are
+    still downloading
+
+    Parameters
+    ----------
+    index: HeaderIndex
+        Where the headers are written
+    workers: int
+        Optional, number of tars processed at the same time
+        Default: workers = 2
+    patterns: list of str
+        Optional, see extract
+    metrics: Metrics
+        Optional, records the time and bytes written of each tar ('extract')
+        Default: metrics = None
+    """
+    def __init__(self, index, workers=2, patterns=None, metrics=None):
+        self.index = index
+        self.patterns = patterns
+        self.metrics = metrics
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._futures = []
+        #(tar, exception) of the tars that failed
+        self.errors = []
+
+    def _process(self, tar_path, dest, arcfile):
+        try:
+            with measure(self.metrics, 'extract', tar=tar_path) as sample:
+                files = extract(tar_path, dest, self.patterns)
+                for f in files:
+                    self.index.add(f, tar_path, arcfile)
+                sample.bytes = sum(os.path.getsize(f) for f in files)
+            return files
+        except Exception as e:
+            self.errors.append((tar_path, e))
+            return []
+
+    def submit(self, tar_path, dest=None, arcfile=None):
+        """
+        Queue a tar to be extracted into dest (default: folder of the tar)
+        """
+        if dest is None:
+            dest = os.path.dirname(os.path.abspath(tar_path))
+        self._futures.append(self._pool.submit(self._process, tar_path, dest, arcfile))
+
+    def wait(self):
+        """
+        Wait for all the queued tars
+
+        Returns
+        -------
+        files: list of str
+            Extracted files
+        """
+        files = []
+        for f in self._futures:
+            files.extend(f.result())
+        self._futures = []
+        return files
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
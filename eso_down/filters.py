@@ -0,0 +1,92 @@
+import numpy as np
+
+def mjd(dates):
+    """
+    Convert a column of dates to MJD floats in one vectorized call
+
+    Parameters
+    ----------
+    dates: array of str
+        Dates in any format understood by astropy Time
+
+    Returns
+    -------
+    mjd: array of float
+    """
+    from astropy.time import Time
+    if len(dates) == 0:
+        return np.zeros(0)
+    return np.asarray(Time(np.asarray(dates)).mjd, dtype=float)
+
+def build_mask(n, criteria):
+    """
+    Combine the criteria in a single boolean mask
+
+    Parameters
+    ----------
+    n: int
+        Number of rows of the table
+    criteria: list of (str, array of bool)
+        Name of the criterion and the rows that pass it.
+        A criterion with mask None is skipped (e.g. missing column)
+
+    Returns
+    -------
+    mask: array of bool
+        Rows that pass every criterion
+    report: dict
+        Number of rows removed by each criterion, counted in order
+        (a row is attributed to the first criterion it fails).
+        Skipped criteria are reported as None
+    """
+    mask = np.ones(n, dtype=bool)
+    report = {}
+    for name, keep in criteria:
+        if keep is None:
+            report[name] = None
+            continue
+        keep = np.asarray(keep, dtype=bool)
+        report[name] = int(np.count_nonzero(mask & ~keep))
+        mask &= keep
+    return mask, report
+
+def apply(table, criteria):
+    """
+    Filter a table with the criteria, slicing it only once
+
+    Parameters
+    ----------
+    table: table
+        Astropy table (or anything that accepts a boolean index)
+    criteria: list of (str, array of bool)
+        See build_mask
+
+    Returns
+    -------
+    table: table
+        Rows of the table that pass every criterion
+    report: dict
+        See build_mask
+    """
+    mask, report = build_mask(len(table), criteria)
+    return table[mask], report
+
+def between(values, vmin=None, vmax=None, closed=True):
+    """
+    Rows with vmin <= values <= vmax. With closed = False the upper
+    limit is excluded. A None limit is not applied
+
+    Returns
+    -------
+    keep: array of bool
+    """
+    values = np.asarray(values, dtype=float)
+    keep = np.ones(len(values), dtype=bool)
+    if vmin is not None:
+        keep &= values >= vmin
+    if vmax is not None:
+        if closed:
+            keep &= values <= vmax
+        else:
+            keep &= values < vmax
+    return keep
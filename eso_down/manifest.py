@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+import time
+
+class RunManifest:
+    """
+    Journal of a batch run, so a rerun continues where it stopped
+
+    Each completed step is appended as one JSON line to the file, so a
+    crash loses at most the step that was running.
+
+    Parameters
+    ----------
+    path: str
+        Adress of the journal file (created if it does not exist)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._steps = {}
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        step = json.loads(line)
+                    except ValueError:
+                        #last line of an interrupted write
+                        continue
+                    self._steps[self._key(step['star'], step['stage'], step.get('item'))] = step.get('data', {})
+
+    def _key(self, star, stage, item=None):
+        return (str(star), str(stage), None if item is None else str(item))
+
+    def mark(self, star, stage, item=None, **data):
+        """
+        Record that a step finished
+
+        Parameters
+        ----------
+        star: str
+            Name of the star
+        stage: str
+            Name of the step (e.g. 'query', 'plan', 'download', 'info')
+        item: str
+            Optional, item of the step (e.g. the ARCFILE downloaded)
+        data:
+            Optional, JSON serializable results of the step
+        """
+        step = {'star': str(star), 'stage': str(stage), 'time': time.time(), 'data': data}
+        if item is not None:
+            step['item'] = str(item)
+        with self._lock:
+            with open(self.path, 'a') as journal:
+                journal.write(json.dumps(step, default=str)+'\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._steps[self._key(star, stage, item)] = data
+
+    def done(self, star, stage, item=None):
+        """
+        Whether a step was already recorded
+        """
+        return self._key(star, stage, item) in self._steps
+
+    def get(self, star, stage, item=None):
+        """
+        Results recorded for a step (None if it was not recorded)
+        """
+        return self._steps.get(self._key(star, stage, item))
+
+    def items(self, star, stage):
+        """
+        Items recorded for a star and step
+        """
+        star, stage = str(star), str(stage)
+        return set(k[2] for k in self._steps if k[0] == star and k[1] == stage and k[2] is not None)
@@ -0,0 +1,200 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+from timeit import default_timer as timer
+
+#upper limits (seconds) of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600.)
+
+class Sample:
+    """
+    One measurement, filled in by the code that is being timed
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.fields = {}
+
+class Metrics:
+    """
+    Latency histograms, bytes, errors and queue depths of each stage
+
+    Every measurement is appended to a JSON-lines log and the totals can
+    be written in the Prometheus text format (node_exporter textfile
+    collector), to see if a run is bound by the archive, Simbad or disk.
+
+    Parameters
+    ----------
+    path: str
+        Optional, adress of the JSON-lines log
+        Default: path = None (no log)
+    buckets: tuple of float
+        Optional, upper limits of the latency histogram in seconds
+        Default: BUCKETS
+    """
+    def __init__(self, path=None, buckets=BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._log = open(path, 'a') if path else None
+        #stage -> {'count', 'errors', 'seconds', 'max', 'bytes', 'histogram'}
+        self.stages = {}
+        #queue -> (last depth, maximum depth)
+        self.queues = {}
+
+    def _write(self, event):
+        if self._log is None:
+            return
+        event['time'] = time.time()
+        self._log.write(json.dumps(event)+'\n')
+        self._log.flush()
+
+    def observe(self, stage, seconds, nbytes=0, error=False, **fields):
+        """
+        Record one call of a stage
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage ('query', 'simbad', 'datalink', 'download', ...)
+        seconds: float
+            Time spent
+        nbytes: int
+            Optional, bytes transferred or written
+        error: bool
+            Optional, True if the call failed
+        fields: dict
+            Optional, more values written to the log (star, url, ...)
+        """
+        with self._lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = {'count': 0, 'errors': 0, 'seconds': 0., 'max': 0.,
+                                          'bytes': 0, 'histogram': [0]*(len(self.buckets)+1)}
+            s['count'] += 1
+            s['errors'] += bool(error)
+            s['seconds'] += seconds
+            s['max'] = max(s['max'], seconds)
+            s['bytes'] += nbytes
+            s['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+            event = {'stage': stage, 'seconds': seconds, 'bytes': nbytes, 'error': bool(error)}
+            event.update(fields)
+            self._write(event)
+
+    def gauge(self, name, value):
+        """
+        Record the depth of a queue
+        """
+        with self._lock:
+            maximum = max(value, self.queues.get(name, (0, 0))[1])
+            self.queues[name] = (value, maximum)
+            self._write({'queue': name, 'depth': value})
+
+    @contextlib.contextmanager
+    def time(self, stage, **fields):
+        """
+        Time a block of code, e.g.
+
+            with metrics.time('download', url=url) as sample:
+                ...
+                sample.bytes = n
+
+        An exception counts as an error of the stage and is raised again
+        """
+        sample = Sample()
+        sample.fields.update(fields)
+        inicio = timer()
+        try:
+            yield sample
+        except BaseException:
+            self.observe(stage, timer() - inicio, sample.bytes, True, **sample.fields)
+            raise
+        self.observe(stage, timer() - inicio, sample.bytes, False, **sample.fields)
+
+    def summary(self):
+        """
+        Totals of each stage
+
+        Returns
+        -------
+        summary: dict
+            stage -> {'count', 'errors', 'seconds', 'mean', 'max', 'bytes', 'bytes_per_s'}
+        """
+        with self._lock:
+            summary = {}
+            for stage, s in self.stages.items():
+                summary[stage] = {'count': s['count'], 'errors': s['errors'],
+                                  'seconds': s['seconds'], 'max': s['max'], 'bytes': s['bytes'],
+                                  'mean': s['seconds']/s['count'] if s['count'] else 0.,
+                                  'bytes_per_s': s['bytes']/s['seconds'] if s['seconds'] > 0 else 0.}
+            return summary
+
+    def prometheus(self, path=None, prefix='eso_down'):
+        """
+        Totals in the Prometheus text format
+
+        Parameters
+        ----------
+        path: str
+            Optional, file where the text is written (replaced atomically)
+        prefix: str
+            Optional, prefix of the metric names
+            Default: prefix = 'eso_down'
+
+        Returns
+        -------
+        text: str
+        """
+        lines = ['# TYPE {}_stage_seconds histogram'.format(prefix)]
+        with self._lock:
+            for stage, s in sorted(self.stages.items()):
+                total = 0
+                for le, n in zip(self.buckets + (float('inf'),), s['histogram']):
+                    total += n
+                    le = '+Inf' if le == float('inf') else repr(le)
+                    lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, stage, le, total))
+                lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, stage, s['seconds']))
+                lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, stage, s['count']))
+            for name, kind, key in (('bytes_total', 'counter', 'bytes'), ('errors_total', 'counter', 'errors')):
+                lines.append('# TYPE {}_stage_{} {}'.format(prefix, name, kind))
+                for stage, s in sorted(self.stages.items()):
+                    lines.append('{}_stage_{}{{stage="{}"}} {}'.format(prefix, name, stage, s[key]))
+            lines.append('# TYPE {}_queue_depth gauge'.format(prefix))
+            for name, (depth, maximum) in sorted(self.queues.items()):
+                lines.append('{}_queue_depth{{queue="{}"}} {}'.format(prefix, name, depth))
+            lines.append('# TYPE {}_queue_depth_max gauge'.format(prefix))
+            for name, (depth, maximum) in sorted(self.queues.items()):
+                lines.append('{}_queue_depth_max{{queue="{}"}} {}'.format(prefix, name, maximum))
+        text = '\n'.join(lines)+'\n'
+        if path:
+            parte = path+'.part'
+            with open(parte, 'w') as f:
+                f.write(text)
+            os.replace(parte, path)
+        return text
+
+    def format(self):
+        """
+        Table with the summary of each stage
+        """
+        lines = ['{:<22}{:>8}{:>8}{:>10}{:>10}{:>12}'.format('stage', 'calls', 'errors', 'mean s', 'max s', 'MB/s')]
+        for stage, s in sorted(self.summary().items()):
+            lines.append('{:<22}{:>8}{:>8}{:>10.2f}{:>10.2f}{:>12.2f}'.format(
+                stage, s['count'], s['errors'], s['mean'], s['max'], s['bytes_per_s']/1024**2))
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+def measure(metrics, stage, **fields):
+    """
+    metrics.time(stage), or a block that records nothing if metrics is None
+    """
+    if metrics is None:
+        return contextlib.nullcontext(Sample())
+    return metrics.time(stage, **fields)
@@ -0,0 +1,95 @@
+import queue
+import threading
+from eso_down.metrics import measure
+
+#marks the end of the items in a queue
+_END = object()
+
+class Pipeline:
+    """
+    Staged pipeline with a pool of worker threads for each stage
+
+    The stages are linked by bounded queues, so a fast stage waits
+    (backpressure) instead of piling up work for a slow one, and all
+    the stages run at the same time.
+
+    Parameters
+    ----------
+    stages: list of (str, function, int)
+        Name, function and number of workers of each stage, in order.
+        The function receives the item returned by the previous stage
+        and returns the item for the next one (None drops the item)
+    maxsize: int
+        Optional, maximum number of items waiting between two stages
+        Default: maxsize = 4
+    metrics: Metrics
+        Optional, records the time and errors of each stage (as
+        'pipeline.<name>') and the depth of the queue before it
+        Default: metrics = None
+    """
+    def __init__(self, stages, maxsize=4, metrics=None):
+        self.stages = list(stages)
+        self.maxsize = maxsize
+        self.metrics = metrics
+        #(stage name, item, exception) of the items that failed
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def _worker(self, name, function, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _END:
+                return
+            if self.metrics is not None:
+                self.metrics.gauge(name, inbox.qsize())
+            try:
+                with measure(self.metrics, 'pipeline.'+name):
+                    result = function(item)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((name, item, e))
+                continue
+            if result is not None:
+                outbox.put(result)
+
+    def _stage(self, name, function, workers, inbox, outbox):
+        threads = [threading.Thread(target=self._worker,
+                                    args=(name, function, inbox, outbox),
+                                    name='{}-{}'.format(name, i), daemon=True)
+                   for i in range(max(1, workers))]
+        for t in threads:
+            t.start()
+        return threads
+
+    def run(self, items):
+        """
+        Run every item through all the stages
+
+        Parameters
+        ----------
+        items: iterable
+            Input of the first stage
+
+        Returns
+        -------
+        results: list
+            Items returned by the last stage (in order of completion)
+        """
+        self.errors = []
+        queues = [queue.Queue(self.maxsize) for _ in self.stages]
+        queues.append(queue.Queue())
+        pools = []
+        for i, (name, function, workers) in enumerate(self.stages):
+            pools.append(self._stage(name, function, workers, queues[i], queues[i+1]))
+        for item in items:
+            queues[0].put(item)
+        #closes the stages in order, once the previous one is empty
+        for i, threads in enumerate(pools):
+            for _ in threads:
+                queues[i].put(_END)
+            for t in threads:
+                t.join()
+        results = []
+        while not queues[-1].empty():
+            results.append(queues[-1].get())
+        return results
@@ -0,0 +1,116 @@
+import numpy as np
+
+def snr_needed(snr, target=1000., start=0.):
+    """
+    Number of spectra (in the given order) needed to reach the target SNR
+
+    Same as adding SNR**2 one spectrum at a time until target**2, but
+    with a cumulative sum. With start the sum begins from the SNR of
+    spectra already added (to extend a previous plan with new spectra)
+
+    Parameters
+    ----------
+    snr: array
+        SNR of each spectrum, in the order they would be added
+    target: float
+        Optional, SNR to reach
+        Default: target = 1000
+    start: float
+        Optional, SNR already reached
+        Default: start = 0
+
+    Returns
+    -------
+    SNR_total: float
+        SNR reached with start and the nspec first spectra
+    nspec: int
+        Number of spectra (all of them if the target is not reached,
+        none if start already reaches it)
+    """
+    if start > 0 and start >= target:
+        return float(start), 0
+    counts = start**2 + np.cumsum(np.asarray(snr, dtype=float)**2)
+    if len(counts) == 0:
+        return float(start), 0
+    nspec = min(int(np.searchsorted(counts, target**2, side='left')) + 1, len(counts))
+    return float(np.sqrt(counts[nspec-1])), nspec
+
+def plan(snr, sizes=None, target=1000.):
+    """
+    Set of spectra that reaches the target SNR downloading few bytes
+    (greedy, so close to the minimum but not always the minimum)
+
+    The spectra are ranked by SNR**2 per byte and taken in that order
+    until the target is reached (cumulative sum). Then the largest
+    files that are not needed to stay above the target are dropped.
+    Without sizes every file counts the same, so it minimizes the
+    number of files.
+
+    Parameters
+    ----------
+    snr: dict or array
+        SNR of the spectra of each epoch (e.g. {'Before': [...], 'After': [...]})
+        or of a single list of spectra
+    sizes: dict or array
+        Optional, size in bytes of the same spectra (nan or None when unknown,
+        replaced by the median of the known ones)
+        Default: sizes = None (all files the same size)
+    target: float
+        Optional, SNR to reach
+        Default: target = 1000
+
+    Returns
+    -------
+    result: dict
+        'files': for each epoch (or 'all'), indices of the chosen spectra,
+        in decreasing SNR;
+        'SNR': predicted SNR of the stack of all the chosen spectra;
+        'nspec': number of chosen spectra;
+        'bytes': predicted transfer volume (None without sizes);
+        'reached': whether the target is reached
+    """
+    if not isinstance(snr, dict):
+        snr = {'all': snr}
+        sizes = None if sizes is None else {'all': sizes}
+    names = list(snr)
+    epoch = np.concatenate([np.full(len(snr[n]), i) for i, n in enumerate(names)]).astype(int)
+    index = np.concatenate([np.arange(len(snr[n])) for n in names]).astype(int)
+    counts = np.concatenate([np.asarray(snr[n], dtype=float) for n in names])**2
+    if sizes is None:
+        size = np.ones(len(counts))
+    else:
+        size = np.concatenate([np.asarray(sizes.get(n) if sizes.get(n) is not None
+                                          else np.full(len(snr[n]), np.nan), dtype=float)
+                               for n in names])
+        known = np.isfinite(size) & (size > 0)
+        size[~known] = np.median(size[known]) if known.any() else 1.
+
+    #best SNR**2 per byte first (ties: highest SNR first)
+    order = np.lexsort((-counts, -counts/size))
+    total = np.cumsum(counts[order])
+    if len(total) == 0:
+        chosen = order
+    else:
+        n = min(int(np.searchsorted(total, target**2, side='left')) + 1, len(total))
+        chosen = order[:n]
+    reached = counts[chosen].sum() >= target**2
+
+    if reached and len(chosen) > 1:
+        #drop the largest files that are not needed to stay above the target
+        keep = np.ones(len(chosen), dtype=bool)
+        excess = counts[chosen].sum() - target**2
+        for i in np.argsort(-size[chosen], kind='stable'):
+            if counts[chosen[i]] <= excess:
+                keep[i] = False
+                excess -= counts[chosen[i]]
+        chosen = chosen[keep]
+
+    files = {}
+    for i, n in enumerate(names):
+        sel = chosen[epoch[chosen] == i]
+        files[n] = index[sel[np.argsort(-counts[sel], kind='stable')]]
+    return {'files': files,
+            'SNR': float(np.sqrt(counts[chosen].sum())),
+            'nspec': int(len(chosen)),
+            'bytes': None if sizes is None else float(size[chosen].sum()),
+            'reached': bool(reached)}
@@ -0,0 +1,134 @@
+import threading
+import numpy as np
+
+def estimate_time(sizes, concurrency=1, bandwidth=5*1024**2, latency=1., total_bandwidth=None):
+    """
+    Wall time to download files with a number of simultaneous connections
+
+    Each file costs latency (datalink lookup and request) plus its size
+    over the bandwidth of one connection, and the files are shared by
+    the connections (a file is never split between them). With
+    total_bandwidth the time is never below the total volume over it.
+
+    Parameters
+    ----------
+    sizes: array
+        Size of each file in bytes
+    concurrency: int
+        Optional, number of simultaneous downloads
+        Default: concurrency = 1
+    bandwidth: float
+        Optional, bytes per second of one connection
+        Default: bandwidth = 5 MB/s
+    latency: float
+        Optional, seconds spent per file before the transfer starts
+        Default: latency = 1
+    total_bandwidth: float
+        Optional, bytes per second of the whole link
+        Default: total_bandwidth = None (no limit)
+
+    Returns
+    -------
+    seconds: float
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    concurrency = max(1, int(concurrency))
+    if len(sizes) == 0:
+        return 0.
+    each = latency + sizes/bandwidth
+    #a file is not shared between connections, so the largest one is a lower limit
+    seconds = max(np.sum(each)/concurrency, np.max(each))
+    if total_bandwidth:
+        seconds = max(seconds, np.sum(sizes)/total_bandwidth)
+    return float(seconds)
+
+def human_bytes(n):
+    """
+    Size in bytes as a short string ('1.5 GB')
+    """
+    n = float(n)
+    for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+        if abs(n) < 1024 or unit == 'TB':
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024
+
+def human_time(seconds):
+    """
+    Time in seconds as a short string ('2h 05m')
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    if seconds < 3600:
+        return '{}m {:02d}s'.format(seconds//60, seconds % 60)
+    return '{}h {:02d}m'.format(seconds//3600, seconds % 3600//60)
+
+class TransferReport:
+    """
+    Files, bytes and estimated time of what a run would download
+
+    Parameters
+    ----------
+    concurrency: int, bandwidth: float, latency: float, total_bandwidth: float
+        Same as in estimate_time
+    """
+    def __init__(self, concurrency=1, bandwidth=5*1024**2, latency=1., total_bandwidth=None):
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.total_bandwidth = total_bandwidth
+        #(star, epoch, sizes)
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def add(self, star, epoch, sizes):
+        """
+        Record the files of one star and epoch
+
+        Parameters
+        ----------
+        star: str
+        epoch: str
+        sizes: array
+            Size of each file in bytes (nan if unknown)
+        """
+        with self._lock:
+            self.rows.append((star, epoch, np.asarray(sizes, dtype=float)))
+
+    def _estimate(self, sizes):
+        known = sizes[np.isfinite(sizes)]
+        return estimate_time(known, self.concurrency, self.bandwidth,
+                             self.latency, self.total_bandwidth)
+
+    def totals(self):
+        """
+        Totals of the whole run
+
+        Returns
+        -------
+        totals: dict
+            'files', 'bytes', 'unknown' (files without size) and 'seconds'
+        """
+        sizes = np.concatenate([r[2] for r in self.rows]) if self.rows else np.zeros(0)
+        return {'files': int(len(sizes)),
+                'bytes': float(np.nansum(sizes)),
+                'unknown': int(np.count_nonzero(~np.isfinite(sizes))),
+                'seconds': self._estimate(sizes)}
+
+    def format(self):
+        """
+        Text of the report, one line per star and epoch plus the total
+        """
+        lines = ['{:<15} {:<7} {:>6} {:>10} {:>10}'.format('star', 'epoch', 'files', 'size', 'time')]
+        for star, epoch, sizes in self.rows:
+            lines.append('{:<15} {:<7} {:>6} {:>10} {:>10}'.format(
+                star, epoch, len(sizes), human_bytes(np.nansum(sizes)),
+                human_time(self._estimate(sizes))))
+        t = self.totals()
+        lines.append('{:<15} {:<7} {:>6} {:>10} {:>10}'.format(
+            'TOTAL', '', t['files'], human_bytes(t['bytes']), human_time(t['seconds'])))
+        if t['unknown']:
+            lines.append('{} files without size in the datalink service'.format(t['unknown']))
+        lines.append('(estimate with {} simultaneous downloads of {}/s)'.format(
+            self.concurrency, human_bytes(self.bandwidth)))
+        return '\n'.join(lines)
@@ -1,17 +1,21 @@
 import numpy as np
 import os
-import astroquery
-from sys import maxsize, stdout
-np.set_printoptions(threshold = maxsize)
-from astropy.time import Time
-from datetime import datetime
-from starsearch.core import Eso
-from starsearch.utils import HMS2deg
-from astroquery.simbad import Simbad
-Simbad.add_votable_fields('flux(V)')
 import eso_down.angle as tt
+import eso_down.filters as filters
+import eso_down.datalink as datalink
+import eso_down.tap as tap
+from eso_down.columnar import colnames, to_columnar
+from eso_down.cache import Cache
+import eso_down.coords as coords
+from eso_down.coords import CoordinateIndex
+from eso_down.store import SpectrumStore
+from eso_down.throttle import RequestScheduler, RETRY_STATUS
+from eso_down.metrics import measure
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 class ESOquery:
     """
@@ -24,35 +28,157 @@ class ESOquery:
     store_password : bool
         Optional, stores the password securely in your keyring
         Default: store_password = False
+    workers: int
+        Optional, number of ancillary files downloaded at the same time
+        Default: workers = 1
+    max_per_host: int
+        Optional, maximum simultaneous connections to each host
+        Default: max_per_host = 4
+    pool_size: int
+        Optional, number of keep-alive connections kept open to each host
+        Default: pool_size = 10
+    cache: Cache or str
+        Optional, cache of the archive and Simbad queries (eso_down.cache.Cache
+        or adress of its SQLite file)
+        Default: cache = None (no cache)
+    coords: CoordinateIndex or str
+        Optional, index with the coordinates of the stars (eso_down.coords.CoordinateIndex
+        or adress of its JSON file)
+        Default: coords = None (index only in memory)
+    store: SpectrumStore or str
+        Optional, local store of the downloaded files (eso_down.store.SpectrumStore
+        or its folder), checked before downloading
+        Default: store = None (no store)
+    scheduler: RequestScheduler
+        Optional, rate limits and retries of every request to ESO and Simbad
+        (eso_down.throttle.RequestScheduler)
+        Default: scheduler = RequestScheduler()
+    metrics: Metrics
+        Optional, timing of the queries, datalink lookups and downloads
+        (eso_down.metrics.Metrics)
+        Default: metrics = None (nothing recorded)
         
     Returns
     -------
     """
-    def __init__(self, user='', store_password=False):
+    def __init__(self, user='', store_password=False, workers=1, max_per_host=4, pool_size=10, cache=None, coords=None, store=None, scheduler=None, metrics=None):
         super(ESOquery, self).__init__()
         #user name
         self.user = user
-        #login to ESO
-        self.eso = Eso()
-        if store_password:
-            self.eso.login(self.user, store_password=True)
-        else:
-            self.eso.login(self.user)
-        #unlimited number of search results = -1
-        self.eso.ROW_LIMIT = -1
-        #list of available surveys
-        self.surveys = self.eso.list_surveys()
+        self.store_password = store_password
+        #ESO login, list of surveys and Simbad are only set up when first used
+        self._eso = None
+        self._surveys = None
+        self._simbad = None
+        self._lazy_lock = threading.Lock()
         #default instruments for our package
         self.instruments = np.array(['FEROS', 'HARPS', 'ESPRESSO'])
         #In the future we might include UVES
         self.UVES = np.array(['UVES'])
+        #cache of the queries
+        if isinstance(cache, str):
+            cache = Cache(cache)
+        self.cache = cache
+        #coordinates of the stars, resolved in batches by self.coords.resolve
+        if not isinstance(coords, CoordinateIndex):
+            coords = CoordinateIndex(coords)
+        self.coords = coords
+        #files already downloaded, shared by all stars and runs
+        if isinstance(store, str):
+            store = SpectrumStore(store)
+        self.store = store
+        #rate limits, adaptive concurrency and retries of each service
+        if scheduler is None:
+            scheduler = RequestScheduler()
+        self.scheduler = scheduler
+        if self.coords.scheduler is None:
+            self.coords.scheduler = scheduler
+        #latency, bytes and errors of each kind of request (also of self.coords)
+        self._metrics = None
+        self.metrics = metrics
+        #rows removed by each criterion in the last search
+        self.filter_report = []
+        #ARCFILEs without ancillary file in the datalink service (skipped)
+        self.no_ancillary = set()
+        #services used by ANCILLARYdown (can point to a local server)
+        self.datalink_url = 'http://archive.eso.org/datalink/links'
+        #ARCFILEs resolved in each datalink request
+        self.datalink_batch = 20
+        #TAP service of queryBulk and number of stars in each of its queries
+        self.tap_url = 'http://archive.eso.org/tap_obs/sync'
+        self.tap_batch = 100
+        #tables of queryBulk, used by querySurveys: (star, surveys) -> table
+        self.prefetched = {}
+        #concurrent downloads
+        self.workers = workers
+        self.max_per_host = max_per_host
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        #one HTTP session for every request, reusing the connections
+        self.pool_size = max(pool_size, max_per_host)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
+    @property
+    def eso(self):
+        """
+        ESO archive service, logged in on first use
+        """
+        with self._lazy_lock:
+            if self._eso is None:
+                from starsearch.core import Eso
+                eso = Eso()
+                if self.store_password:
+                    eso.login(self.user, store_password=True)
+                else:
+                    eso.login(self.user)
+                #unlimited number of search results = -1
+                eso.ROW_LIMIT = -1
+                self._eso = eso
+        return self._eso
 
+    @property
+    def surveys(self):
+        """
+        List of available surveys, asked on first use
+        """
+        if self._surveys is None:
+            self._surveys = self.eso.list_surveys()
+        return self._surveys
 
-    def searchStarbef(self, star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None, R=None):
-        """star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None)
-        Return phase 3 ESO query for selected star. 
-        Includes other options such as instrument, date, and signal-to-noise.
+    @property
+    def simbad(self):
+        """
+        Simbad service (with the V magnitude field), set up on first use
+        """
+        with self._lazy_lock:
+            if self._simbad is None:
+                from astroquery.simbad import SimbadClass
+                simbad = SimbadClass()
+                simbad.add_votable_fields('flux(V)')
+                self._simbad = simbad
+        return self._simbad
+
+    @property
+    def metrics(self):
+        """
+        Metrics of the requests (None: nothing recorded)
+        """
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        #the Simbad queries of self.coords are recorded in the same place,
+        #unless it has metrics of its own
+        if self.coords.metrics is None or self.coords.metrics is self._metrics:
+            self.coords.metrics = metrics
+        self._metrics = metrics
+
+    def _query(self, star, instrument = None):
+        """
+        Run the phase 3 archive and Simbad queries for a star only once
         
         Parameters
         ----------
@@ -61,9 +187,235 @@ class ESOquery:
         instrument: str
             Name of the instrument
             If None: Uses our default instruments
-        date: str
-            Date to search for obvervation ('YYYY-MM-DD')
-            If None: date = '2015-06-03' (date of HARPS upgrade)
+            
+        Returns
+        -------
+        search: table
+            Result of the query on ESO arquive
+        position: tuple
+            RA and DEC of the star in degrees (see position)
+        """
+        return self.querySurveys(star, instrument), self.position(star)
+
+    def querySurveys(self, star, instrument = None):
+        """
+        Phase 3 archive query of a star, through the cache if there is one
+        """
+        if instrument:
+            surveys = instrument
+        else:
+            surveys = list(self.instruments)
+        prefetched = self.prefetched.get((star, self._surveys_key(surveys)))
+        if prefetched is not None:
+            return prefetched
+        def query():
+            with measure(self.metrics, 'query', star=star):
+                return self.scheduler.call('query', self.eso.query_surveys, surveys = surveys, target = star)
+        if self.cache is None:
+            return query()
+        return self.cache.fetch(('surveys', star, surveys), query)
+
+    def _surveys_key(self, surveys):
+        return tuple(str(s) for s in np.atleast_1d(surveys))
+
+    def _tap(self, ra, dec, dist, surveys, since=None):
+        """
+        One bulk query of the stars at (ra, dec)
+        """
+        data = {'REQUEST': 'doQuery', 'LANG': 'ADQL', 'FORMAT': 'csv',
+                'QUERY': tap.adql(ra, dec, dist, surveys, since=since)}
+        with measure(self.metrics, 'query', stars=len(ra)) as sample:
+            rq = self.scheduler.request('query', self.session, 'POST', self.tap_url, data=data)
+            rq.raise_for_status()
+            sample.bytes = len(rq.content)
+        return tap.split(tap.parse(rq.content), ra, dec, dist)
+
+    def queryBulk(self, stars, instrument = None, dist = None, since = None):
+        """
+        Phase 3 archive query of many stars with a few TAP queries
+
+        Instead of one query_surveys for each star, the stars are sent in
+        groups of self.tap_batch as cones of a single ADQL query on
+        ivoa.ObsCore, asking only for the columns used here (tap.COLUMNS),
+        and the rows are split back by star. The tables are kept in
+        self.prefetched, so querySurveys and the search methods use them
+        without another query. In the cache they have a key of their own
+        (with 'tap' and dist), apart from the full query_surveys tables.
+
+        Parameters
+        ----------
+        stars: list of str
+            Names of the stars (coordinates from self.coords)
+        instrument: str or list of str
+            Name of the instrument
+            If None: Uses our default instruments
+        dist: float
+            Radius of the cones in arcsec
+            If None: dist = 30
+        since: dict
+            star -> MJD, only the spectra observed from then on (None or
+            a missing star: all of them). These partial tables are not
+            kept in self.prefetched nor in the cache
+
+        Returns
+        -------
+        tables: dict
+            star -> table with the columns ARCFILE, Date Obs, SNR (spectra),
+            RA, DEC and R (&lambda;/&delta;&lambda;). Stars without
+            coordinates are left out
+        """
+        if instrument:
+            surveys = instrument
+        else:
+            surveys = list(self.instruments)
+        if not dist:
+            dist = 30
+        key = self._surveys_key(surveys)
+        stars = list(dict.fromkeys(str(s) for s in stars))
+        ra, dec = self.coords.resolve(stars)
+        tables, pending = {}, []
+        for star, a, d in zip(stars, ra, dec):
+            if not np.isfinite(a):
+                continue
+            if since is not None:
+                t = since.get(star)
+                pending.append((star, a, d, np.nan if t is None else t))
+                continue
+            if self.cache is not None:
+                try:
+                    tables[star] = self.cache.get(('tap', star, surveys, dist))
+                    continue
+                except KeyError:
+                    pass
+            pending.append((star, a, d, np.nan))
+        groups = [pending[i:i+self.tap_batch] for i in range(0, len(pending), self.tap_batch)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(groups) or 1))) as pool:
+            results = pool.map(lambda g: self._tap([x[1] for x in g], [x[2] for x in g], dist, key,
+                                                   [x[3] for x in g]), groups)
+            for group, parts in zip(groups, results):
+                for (star, a, d, t), table in zip(group, parts):
+                    tables[star] = table
+                    if self.cache is not None and since is None:
+                        self.cache.set(('tap', star, surveys, dist), table)
+        if since is None:
+            for star, table in tables.items():
+                self.prefetched[(star, key)] = table
+        return tables
+
+    def querySimbad(self, star):
+        """
+        Simbad query of a star, through the cache if there is one
+        """
+        def query():
+            with measure(self.metrics, 'simbad', star=star):
+                return self.scheduler.call('simbad', self.simbad.query_object, star)
+        if self.cache is None:
+            return query()
+        return self.cache.fetch(('simbad', star), query)
+
+    def position(self, star):
+        """
+        RA and DEC of a star in degrees, from the coordinate index or, 
+        if it is not there, from Simbad
+
+        Parameters
+        ----------
+        star: str
+            Name of the star
+
+        Returns
+        -------
+        position: tuple
+            (ra, dec) in degrees
+        """
+        pos = self.coords.get(star)
+        if pos is None:
+            ra, dec = coords.from_simbad(self.querySimbad(star))
+            self.coords.add(star, ra[0], dec[0])
+            pos = self.coords.get(star)
+        return pos
+
+    def _column(self, search, name):
+        """
+        Numeric column of the table as an array of float (masked values
+        as nan, as in to_columnar), or None if it does not exist
+        """
+        if name in colnames(search):
+            return np.asarray(np.ma.filled(np.ma.asarray(search[name], dtype=float), np.nan))
+        return None
+
+    def _cut(self, search, position, dateMin, dateMax, SNRmin, SNRmax, dist, R, mjd=None, reports=None):
+        """
+        Apply the date, SNR, position and resolution criteria to the 
+        archive table with a single boolean mask
+        
+        Parameters
+        ----------
+        search: table
+            Result of the query on ESO arquive
+        position: tuple
+            RA and DEC of the star in degrees
+        dateMin, dateMax: Time
+            Observations are kept if dateMin <= Date Obs < dateMax
+            If None: no limit on that side
+        SNRmin, SNRmax, dist, R: float
+            Same as in searchStarEpochs
+        mjd: array
+            'Date Obs' already converted to MJD
+            If None: computed from the table
+        reports: list
+            the report of the filters is appended to it
+            If None: stored in self.filter_report
+            
+        Returns
+        -------
+        search: table
+            Filtered copy of the table
+        """
+        if mjd is None and 'Date Obs' in colnames(search):
+            mjd = filters.mjd(search['Date Obs'])
+        dates = None
+        if mjd is not None:
+            dates = filters.between(mjd, 
+                                    None if dateMin is None else dateMin.mjd,
+                                    None if dateMax is None else dateMax.mjd,
+                                    closed=False)
+        SNR = self._column(search, 'SNR (spectra)')
+        RA = self._column(search, 'RA')
+        DEC = self._column(search, 'DEC')
+        res = self._column(search, 'R (&lambda;/&delta;&lambda;)')
+        inside = None
+        if RA is not None and DEC is not None:
+            #great-circle distance, correct near the poles and across RA = 0
+            inside = tt.cone(np.asarray(RA, dtype=float), np.asarray(DEC, dtype=float), 
+                             position[0], position[1], dist)
+        criteria = [('date', dates), #Date criteria
+                    ('SNR', None if SNR is None else filters.between(SNR, SNRmin, SNRmax)), #SNR critetia
+                    ('position', inside), #Distance criteria
+                    ('R', None if res is None else res == R)]
+        search, report = filters.apply(search, criteria)
+        if reports is None:
+            self.filter_report = [report]
+        else:
+            reports.append(report)
+        return search
+
+    def searchStarEpochs(self, star, instrument = None, dates = None, SNRmin = None, SNRmax = None, dist = None, R = None, columnar = False):
+        """
+        Return phase 3 ESO query for selected star split in epochs.
+        The archive and Simbad are queried only once and the result is 
+        partitioned around the given dates.
+        
+        Parameters
+        ----------
+        star: str
+            Name of the star
+        instrument: str
+            Name of the instrument
+            If None: Uses our default instruments
+        dates: list of str
+            Epoch boundaries ('YYYY-MM-DD')
+            If None: dates = ['2015-06-03'] (date of HARPS upgrade)
         SNRmin: float
             Minimal signal to noise ratio. 
             If None: SNRmin = 1
@@ -76,16 +428,48 @@ class ESOquery:
         R: float
             The resolution
             If None: R = 115000
-        
+        columnar: bool
+            Optional, return slim structured arrays with only the columns
+            used here (see eso_down.columnar.to_columnar) instead of tables
+            Default: columnar = False
             
         Returns
         -------
+        epochs: list of tables
+            len(dates)+1 tables, one for each interval between the dates 
+            (the first one is before dates[0], the last one after dates[-1])
+        """
+        search, position = self._query(star, instrument)
+        return self.splitEpochs(search, position, dates, SNRmin, SNRmax, dist, R, columnar)
+
+    def splitEpochs(self, search, position, dates = None, SNRmin = None, SNRmax = None, dist = None, R = None, columnar = False):
+        """
+        Filter an archive query already made and split it in epochs
+        
+        Parameters
+        ----------
         search: table
-            Result of the query on ESO arquive
+            Result of the query on ESO arquive (see querySurveys)
+        position: tuple or table
+            RA and DEC of the star in degrees (see position), or the
+            result of the query on Simbad (see querySimbad)
+        dates, SNRmin, SNRmax, dist, R, columnar:
+            Same as in searchStarEpochs
+            
+        Returns
+        -------
+        epochs: list of tables
+            Same as in searchStarEpochs
         """
-        if not date: 
-            date = Time('2015-06-03')
-        date = Time(date)
+        from astropy.time import Time
+        if not isinstance(position, tuple):
+            ra, dec = coords.from_simbad(position)
+            position = (ra[0], dec[0])
+        if dates is None:
+            dates = ['2015-06-03']
+        if isinstance(dates, (str, Time)):
+            dates = [dates]
+        dates = sorted(Time(d) for d in dates)
         if not SNRmin: 
             SNRmin = 1
         if not SNRmax:
@@ -94,37 +478,22 @@ class ESOquery:
             dist=30
         if not R:
             R=115000
-        if instrument:
-            search = self.eso.query_surveys(surveys=instrument,target=star)
-        else:
-            search = self.eso.query_surveys(surveys = list(self.instruments), 
-                                            target = star)
-        
-        sSearch=Simbad.query_object(star)
-        RAref = tt.ra(sSearch['RA'][0][0:2],sSearch['RA'][0][3:5],sSearch['RA'][0][6:len(sSearch['RA'][0])])    
-        RAmin = (RAref - dist)/3600
-        RAmax = (RAref+dist)/3600
-        decRef = tt.dec(sSearch['DEC'][0][0:3],sSearch['DEC'][0][3:6],sSearch['DEC'][0][6:len(sSearch['DEC'][0])])
-        decMin = (decRef-dist)/3600
-        decMax = (decRef+dist)/3600
-
-        try:
-            search.remove_rows(Time(search['Date Obs']) > date) #Date criteria
-            search.remove_rows(search['SNR (spectra)'] < SNRmin) #SNR critetia
-            search.remove_rows(search['SNR (spectra)'] > SNRmax) #SNR critetia
-            search.remove_rows(search['RA'] < RAmin)
-            search.remove_rows(search['RA'] > RAmax)
-            search.remove_rows(search['DEC'] < decMin)
-            search.remove_rows(search['DEC'] > decMax)
-            search.remove_rows(search['R (&lambda;/&delta;&lambda;)'] != R)
-
-
-
-        except:
-            pass
-        return search
+        #the cuts work on the slim array, so each epoch only copies the used columns
+        if columnar:
+            search = to_columnar(search)
+        #dates converted only once for all the epochs
+        mjd = None
+        if 'Date Obs' in colnames(search):
+            mjd = filters.mjd(search['Date Obs'])
+        bounds = [None] + list(dates) + [None]
+        epochs, reports = [], []
+        for i in range(0, len(bounds)-1):
+            epochs.append(self._cut(search, position, bounds[i], bounds[i+1], 
+                                    SNRmin, SNRmax, dist, R, mjd, reports))
+        self.filter_report = reports
+        return epochs
 
-    def searchStaraft(self, star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None,R=None):
+    def searchStarbef(self, star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None, R=None, columnar = False):
         """star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None)
         Return phase 3 ESO query for selected star. 
         Includes other options such as instrument, date, and signal-to-noise.
@@ -151,6 +520,9 @@ class ESOquery:
         R: float
             The resolution
             If None: R = 115000
+        columnar: bool
+            Optional, return a slim structured array (see searchStarEpochs)
+            Default: columnar = False
         
             
         Returns
@@ -159,45 +531,51 @@ class ESOquery:
             Result of the query on ESO arquive
         """
         if not date: 
-            date = Time('2015-06-03')
-        date = Time(date)
-        if not SNRmin: 
-            SNRmin = 1
-        if not SNRmax:
-            SNRmax=500
-        if not dist:
-            dist=30
-        if not R:
-            R=115000
-        if instrument:
-            search = self.eso.query_surveys(surveys=instrument, target=star)
-        else:
-            search = self.eso.query_surveys(surveys = list(self.instruments), 
-                                            target = star)
+            date = '2015-06-03'
+        return self.searchStarEpochs(star, instrument, [date], SNRmin, 
+                                     SNRmax, dist, R, columnar)[0]
+
+    def searchStaraft(self, star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None,R=None, columnar = False):
+        """star, instrument = None, date = None, SNRmin = None,SNRmax=None, dist = None)
+        Return phase 3 ESO query for selected star. 
+        Includes other options such as instrument, date, and signal-to-noise.
         
-        sSearch=Simbad.query_object(star)
-        RAref = tt.ra(sSearch['RA'][0][0:2],sSearch['RA'][0][3:5],sSearch['RA'][0][6:len(sSearch['RA'][0])])    
-        RAmin = (RAref - dist)/3600
-        RAmax = (RAref+dist)/3600
-        decRef = tt.dec(sSearch['DEC'][0][0:3],sSearch['DEC'][0][3:6],sSearch['DEC'][0][6:len(sSearch['DEC'][0])])
-        decMin = (decRef-dist)/3600
-        decMax = (decRef+dist)/3600
-
-        try:
-            search.remove_rows(Time(search['Date Obs']) < date) #Date criteria
-            search.remove_rows(search['SNR (spectra)'] < SNRmin) #SNR critetia
-            search.remove_rows(search['SNR (spectra)'] > SNRmax) #SNR critetia
-            search.remove_rows(search['RA'] < RAmin)
-            search.remove_rows(search['RA'] > RAmax)
-            search.remove_rows(search['DEC'] < decMin)
-            search.remove_rows(search['DEC'] > decMax)
-            search.remove_rows(search['R (&lambda;/&delta;&lambda;)'] != R)
-
-
-
-        except:
-            pass
-        return search
+        Parameters
+        ----------
+        star: str
+            Name of the star
+        instrument: str
+            Name of the instrument
+            If None: Uses our default instruments
+        date: str
+            Date to search for obvervation ('YYYY-MM-DD')
+            If None: date = '2015-06-03' (date of HARPS upgrade)
+        SNRmin: float
+            Minimal signal to noise ratio. 
+            If None: SNRmin = 1
+        SNRmax: float
+            Maximum signal to noise
+            IF None: SNRmax = 500
+        dist: float
+            Maximum distance (in arcsec) from RA and DEC
+            If None: dist = 30
+        R: float
+            The resolution
+            If None: R = 115000
+        columnar: bool
+            Optional, return a slim structured array (see searchStarEpochs)
+            Default: columnar = False
+        
+            
+        Returns
+        -------
+        search: table
+            Result of the query on ESO arquive
+        """
+        if not date: 
+            date = '2015-06-03'
+        return self.searchStarEpochs(star, instrument, [date], SNRmin, 
+                                     SNRmax, dist, R, columnar)[-1]
 
     def searchStar(self, star, instrument = None, date = None, SNR = None):
         """
@@ -223,21 +601,20 @@ class ESOquery:
         search: table
             Result of the query on ESO arquive
         """
+        from astropy.time import Time
         if not date: 
             date = Time('1990-01-23')
         date = Time(date)
         if not SNR: 
             SNR = 1
-        if instrument:
-            search = self.eso.query_surveys(surveys=instrument, target=star)
-        else:
-            search = self.eso.query_surveys(surveys = list(self.instruments), 
-                                            target = star)
-        try:
-            search.remove_rows(Time(search['Date Obs']) < date) #Date criteria
-            search.remove_rows(search['SNR (spectra)'] < SNR) #SNR critetia
-        except:
-            pass
+        search = self.querySurveys(star, instrument)
+        dates, SNRs = None, self._column(search, 'SNR (spectra)')
+        if 'Date Obs' in colnames(search):
+            dates = filters.mjd(search['Date Obs']) >= date.mjd
+        criteria = [('date', dates), #Date criteria
+                    ('SNR', None if SNRs is None else filters.between(SNRs, SNR))] #SNR critetia
+        search, report = filters.apply(search, criteria)
+        self.filter_report = [report]
         return search
     
     def _searchAndDownload(self, star, instrument, downloadPath, date, SNR):
@@ -290,46 +667,289 @@ class ESOquery:
         else:
             self.eso.retrieve_data(datasets = starArcfile,with_calib='processed')
 
-    def baixar_arquivo(self,url, endereco):
+    def connection_stats(self):
+        """
+        Connection reuse counters of the HTTP session
+
+        Returns
+        -----------------------------
+        stats: dict
+            for each host, the number of requests made and of new 
+            connections opened (TCP+TLS handshakes), plus the totals 
+            in 'total'
+        """
+        stats = {}
+        adapters = {id(a): a for a in self.session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = '{}://{}:{}'.format(pool.scheme, pool.host, pool.port)
+                stats[host] = {'requests': pool.num_requests, 
+                               'connections': pool.num_connections}
+        stats['total'] = {'requests': sum(h['requests'] for h in stats.values()),
+                          'connections': sum(h['connections'] for h in stats.values())}
+        return stats
+
+    def _remote_size(self, url):
+        """
+        Size in bytes of the file in url (None if the server does not say)
+        """
+        resposta = self.scheduler.request('dataportal', self.session, 'HEAD', url, allow_redirects=True)
+        if resposta.status_code == requests.codes.OK and 'Content-Length' in resposta.headers:
+            return int(resposta.headers['Content-Length'])
+        return None
+
+    def baixar_arquivo(self,url, endereco, tamanho=None, chunk_size=64*1024):
         """
         Download a file with the url
 
+        The file is streamed in chunks to endereco+'.part' and renamed to
+        endereco only when complete, so the memory used does not depend
+        on the size of the file. If a .part file exists the download is
+        resumed with a HTTP Range request, and if endereco already exists
+        with the expected size nothing is downloaded.
+
         Parameters
         -----------------------------
         url: str
             the url to download
         endereco: str
             adress where to download with the name and type of the final file
+        tamanho: int
+            expected size of the file in bytes
+            If None: asked to the server when endereco already exists
+        chunk_size: int
+            size in bytes of each chunk written to disk (a chunk cut by
+            a lost connection is lost, the rest is resumed)
+
+        Returns
+        -----------------------------
+        endereco: str
+            adress of the downloaded file
         """
-        resposta = requests.get(url)
-        if resposta.status_code == requests.codes.OK:
-            with open(endereco, 'wb') as novo_arquivo:
-                    novo_arquivo.write(resposta.content)
-            print("Download done. file saved in: {}".format(endereco))
-        else:
-            resposta.raise_for_status()
+        if os.path.exists(endereco):
+            if tamanho is None:
+                tamanho = self._remote_size(url)
+            if tamanho is not None and os.path.getsize(endereco) == tamanho:
+                print("File already downloaded: {}".format(endereco))
+                return endereco
+        parte = endereco+'.part'
+        def transferir(sample):
+            #a connection lost in the middle is retried by the scheduler,
+            #resuming from what is already in the .part file
+            inicio = os.path.getsize(parte) if os.path.exists(parte) else 0
+            headers = {}
+            if inicio:
+                headers['Range'] = 'bytes={}-'.format(inicio)
+            with self.session.get(url, headers=headers, stream=True) as resposta:
+                if resposta.status_code == requests.codes.requested_range_not_satisfiable:
+                    #the .part file is already complete
+                    pass
+                elif resposta.status_code in (requests.codes.OK, requests.codes.partial_content):
+                    #the server may ignore the Range and send the whole file
+                    modo = 'ab' if resposta.status_code == requests.codes.partial_content else 'wb'
+                    with open(parte, modo) as novo_arquivo:
+                        for chunk in resposta.iter_content(chunk_size=chunk_size):
+                            novo_arquivo.write(chunk)
+                            #on disk before the connection can be lost
+                            novo_arquivo.flush()
+                            sample.bytes += len(chunk)
+                elif resposta.status_code not in RETRY_STATUS:
+                    resposta.raise_for_status()
+            return resposta
+        with measure(self.metrics, 'download', url=url) as sample:
+            resposta = self.scheduler.call('dataportal', transferir, sample)
+            if resposta.status_code in RETRY_STATUS:
+                resposta.raise_for_status()
+        if tamanho is not None and os.path.getsize(parte) != tamanho:
+            raise IOError("Incomplete download of {}: {} of {} bytes".format(
+                url, os.path.getsize(parte), tamanho))
+        os.replace(parte, endereco)
+        print("Download done. file saved in: {}".format(endereco))
+        return endereco
+
+    def _host_slot(self, url):
+        """
+        Semaphore limiting the simultaneous connections to the host of url
+        """
+        host = urlparse(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _datalinks(self, arcfiles):
+        """
+        Ancillary links of several ARCFILEs with one datalink request
+
+        If the service does not answer for some of the identifiers 
+        they are asked again one by one. ARCFILEs that still have no
+        ancillary file are left out of links and kept in self.no_ancillary.
+
+        Parameters
+        --------------------------
+        arcfiles: list of str
+            ARCFILEs of the spectra
+
+        Returns
+        --------------------------
+        links: dict
+            ARCFILE -> ancillary link (see eso_down.datalink.ancillary)
+        """
+        params = [('ID', datalink.ivo_id(arc)) for arc in arcfiles]
+        params.append(('RESPONSEFORMAT', 'json'))
+        with measure(self.metrics, 'datalink', ids=len(arcfiles)) as sample:
+            with self._host_slot(self.datalink_url):
+                rq = self.scheduler.request('datalink', self.session, 'GET', self.datalink_url, params=params)
+            rq.raise_for_status()
+            sample.bytes = len(rq.content)
+        links = datalink.ancillary(datalink.parse(rq.content))
+        missing = [arc for arc in arcfiles if arc not in links]
+        if len(arcfiles) > 1:
+            for arc in missing:
+                links.update(self._datalinks([arc]))
+        elif missing:
+            #permanent: skipped so the other files of the star are not blocked
+            self.no_ancillary.add(arcfiles[0])
+            print("No ancillary file found for {}, skipped".format(arcfiles[0]))
+        return links
+
+    def fileSizes(self, arcfiles):
+        """
+        Size in bytes of the ancillary file of each ARCFILE, from the 
+        datalink service (nothing is downloaded)
+
+        Parameters
+        --------------------------
+        arcfiles: list of str
+            ARCFILEs of the spectra
+
+        Returns
+        --------------------------
+        sizes: array
+            size of each file, nan when the service does not give it
+            (or there is no ancillary file)
+        """
+        arcfiles = [str(arc) for arc in arcfiles]
+        size = max(1, self.datalink_batch)
+        batches = [arcfiles[i:i+size] for i in range(0, len(arcfiles), size)]
+        links = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            for found in pool.map(self._datalinks, batches):
+                links.update(found)
+        return np.array([np.nan if arc not in links or links[arc]['content_length'] is None 
+                         else links[arc]['content_length'] for arc in arcfiles], dtype=float)
+
+    def _download(self, link, downloadPath, on_done=None):
+        """
+        Download one ancillary file
+
+        Parameters
+        --------------------------
+        link: dict
+            ancillary link given by _datalinks
+        downloadPath: str
+            adress where to download
+        on_done: function
+            called as on_done(arcfile, endereco) after the download
 
-    def ANCILLARYdown(self,arq,downloadPath):
+        Returns
+        --------------------------
+        endereco: str
+            adress of the downloaded file
+        """
+        name = link['name']
+        if not name.endswith(('.tar', '.tgz', '.tar.gz')):
+            name = name+'.tar'
+        endereco = str(downloadPath)+'/'+name
+        with self._host_slot(link['access_url']):
+            self.baixar_arquivo(link['access_url'], endereco, link['content_length'])
+        if self.store is not None:
+            self.store.add(link['arcfile'], endereco, name)
+        if on_done is not None:
+            on_done(link['arcfile'], endereco)
+        return endereco
+
+    def _from_store(self, arcfile, downloadPath, on_done=None):
+        """
+        Link the ancillary file of an ARCFILE from the local store
+
+        Returns
+        --------------------------
+        endereco: str
+            adress of the file, None if it is not in the store
+        """
+        if self.store is None:
+            return None
+        entry = self.store.get(arcfile)
+        if entry is None:
+            return None
+        endereco = str(downloadPath)+'/'+entry['name']
+        self.store.link(arcfile, endereco)
+        print("File taken from the local store: {}".format(endereco))
+        if on_done is not None:
+            on_done(arcfile, endereco)
+        return endereco
+
+    def ANCILLARYdown(self,arq,downloadPath,workers=None,on_done=None):
         """
         Download the ancillary files from ESO
 
+        The ARCFILEs are resolved in the datalink service in batches of
+        self.datalink_batch identifiers, and the files of each batch 
+        start downloading as soon as it is resolved, so with workers > 1
+        the lookups overlap with the downloads. Files already in the 
+        local store (self.store) are linked without any request.
+
         Parameters
         --------------------------
         arq: table
             table from ESO with the spectra
         downloadPath: str
             adress where to download
+        workers: int
+            number of requests made at the same time
+            If None: workers = self.workers
+        on_done: function
+            called as on_done(arcfile, endereco) after each file is 
+            downloaded (from the worker threads)
+
+        Returns
+        --------------------------
+        files: list of str
+            adresses of the downloaded files, in the order of arq
+            (ARCFILEs without ancillary file are left out, see 
+            self.no_ancillary)
         """
-        arcbef=np.array(arq['ARCFILE'])
-        arqname=[]
-        for i in range(0,len(arcbef)):
-            id = arcbef[i]+'&RESPONSEFORMAT=json'
-            rq = requests.get('http://archive.eso.org/datalink/links?ID=ivo://eso.org/ID?'+id)
-            soup = BeautifulSoup(rq.content, 'html.parser')
-            strsoup = str(soup)
-            arqname.append(strsoup[2116:2143])
-        link_pri='https://dataportal.eso.org/dataPortal/file/'
-        tar='.tar'
-        for i in range(0,len(arqname)):
-            self.baixar_arquivo(link_pri+str(arqname[i]),str(downloadPath)+'/'+str(arqname[i])+tar)
-        
+        if not workers:
+            workers = self.workers
+        arcbef=[str(arc) for arc in np.array(arq['ARCFILE'])]
+        files = {}
+        for arc in arcbef:
+            endereco = self._from_store(arc, downloadPath, on_done)
+            if endereco is not None:
+                files[arc] = endereco
+        faltam = [arc for arc in arcbef if arc not in files]
+        size = max(1, self.datalink_batch)
+        batches = [faltam[i:i+size] for i in range(0, len(faltam), size)]
+        if workers == 1 or len(faltam) <= 1:
+            for batch in batches:
+                links = self._datalinks(batch)
+                for arc in batch:
+                    if arc in links:
+                        files[arc] = self._download(links[arc], downloadPath, on_done)
+            return [files[arc] for arc in arcbef if arc in files]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            lookups = [pool.submit(self._datalinks, batch) for batch in batches]
+            downloads = {}
+            for batch, lookup in zip(batches, lookups):
+                links = lookup.result()
+                for arc in batch:
+                    if arc in links:
+                        downloads[arc] = pool.submit(self._download, links[arc], downloadPath, on_done)
+            for arc in downloads:
+                files[arc] = downloads[arc].result()
+            return [files[arc] for arc in arcbef if arc in files]
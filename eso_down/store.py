@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+
+def checksum(path, chunk_size=1024*1024):
+    """
+    SHA-256 of a file, read in chunks
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class SpectrumStore:
+    """
+    Local store of the downloaded files, keyed by ARCFILE and checksum
+
+    Each file is kept once in <root>/objects (named by its SHA-256) and
+    the per-star folders get hardlinks to it (symlinks if the folders are
+    in another file system), so an ARCFILE that is needed again is not
+    downloaded again.
+
+    Parameters
+    ----------
+    root: str
+        Folder of the store (created if it does not exist)
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, 'index.sqlite'), check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'key TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, name TEXT)')
+        self._db.commit()
+        #files served from the store instead of the network
+        self.hits = 0
+        self.bytes_saved = 0
+
+    def _object(self, sha):
+        return os.path.join(self.root, 'objects', sha[:2], sha)
+
+    def get(self, key):
+        """
+        Stored file of a key
+
+        Returns
+        -------
+        entry: dict or None
+            'sha256', 'size', 'name' and 'path' of the object, None if the
+            key is not stored (or its object was removed)
+        """
+        with self._lock:
+            row = self._db.execute('SELECT sha256, size, name FROM files WHERE key = ?',
+                                   (str(key),)).fetchone()
+        if row is None or not os.path.exists(self._object(row[0])):
+            return None
+        return {'sha256': row[0], 'size': row[1], 'name': row[2], 'path': self._object(row[0])}
+
+    def add(self, key, path, name=None):
+        """
+        Move a downloaded file into the store and link it back in place
+
+        Parameters
+        ----------
+        key: str
+            Key of the file (ARCFILE)
+        path: str
+            Adress of the downloaded file
+        name: str
+            Optional, name of the file in the per-star folders
+            Default: basename of path
+
+        Returns
+        -------
+        entry: dict
+            Same as get
+        """
+        sha = checksum(path)
+        obj = self._object(sha)
+        size = os.path.getsize(path)
+        with self._lock:
+            if os.path.exists(obj):
+                #same content already stored under another key
+                os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                shutil.move(path, obj)
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                             (str(key), sha, size, name or os.path.basename(path)))
+            self._db.commit()
+        self._link(obj, path)
+        return self.get(key)
+
+    def _link(self, obj, dest):
+        if os.path.exists(dest) or os.path.islink(dest):
+            if os.path.exists(dest) and os.path.samefile(obj, dest):
+                return
+            os.remove(dest)
+        try:
+            os.link(obj, dest)
+        except OSError:
+            os.symlink(os.path.abspath(obj), dest)
+
+    def link(self, key, dest):
+        """
+        Put the stored file of a key in dest without downloading it
+
+        Parameters
+        ----------
+        key: str
+            Key of the file (ARCFILE)
+        dest: str
+            Adress of the link to create
+
+        Returns
+        -------
+        linked: bool
+            False if the key is not stored
+        """
+        entry = self.get(key)
+        if entry is None:
+            return False
+        self._link(entry['path'], dest)
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += entry['size']
+        return True
+
+    def stats(self):
+        """
+        Number of stored objects and their size, and what the store saved
+
+        Returns
+        -------
+        stats: dict
+        """
+        with self._lock:
+            keys = self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            objects, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM '
+                '(SELECT sha256, MAX(size) AS size FROM files GROUP BY sha256)').fetchone()
+        return {'keys': keys, 'objects': objects, 'bytes': size,
+                'hits': self.hits, 'bytes_saved': self.bytes_saved}
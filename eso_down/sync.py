@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+import numpy as np
+import eso_down.filters as filters
+from eso_down.columnar import colnames
+
+class SyncState:
+    """
+    What was already seen in the archive for each star, to ask only for
+    the newer observations in the next runs
+
+    For each star it keeps the latest 'Date Obs' (as MJD) and the set of
+    ARCFILEs already returned by the archive (downloaded or not).
+
+    Parameters
+    ----------
+    path: str
+        Adress of the JSON file (read if it exists)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.stars = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for star, entry in json.load(f).items():
+                    self.stars[star] = {'last_mjd': entry.get('last_mjd'),
+                                        'seen': set(entry.get('seen', []))}
+
+    def __contains__(self, star):
+        return star in self.stars
+
+    def since(self, star):
+        """
+        MJD of the latest observation seen of a star (None if never synced)
+        """
+        entry = self.stars.get(star)
+        return None if entry is None else entry['last_mjd']
+
+    def seen(self, star):
+        """
+        ARCFILEs already seen of a star
+        """
+        entry = self.stars.get(star)
+        return set() if entry is None else set(entry['seen'])
+
+    def new_rows(self, star, table):
+        """
+        Rows of an archive table with ARCFILEs not seen yet
+
+        Parameters
+        ----------
+        star: str
+        table: table
+            Result of the archive query (with the ARCFILE column)
+
+        Returns
+        -------
+        table: table
+        """
+        seen = self.stars.get(star, {}).get('seen')
+        if not seen or len(table) == 0:
+            return table
+        arcfiles = np.asarray(table['ARCFILE'], dtype=str)
+        return table[~np.isin(arcfiles, np.array(sorted(seen), dtype=str))]
+
+    def update(self, star, table=None, arcfiles=()):
+        """
+        Mark the rows of a table (and more ARCFILEs) as seen
+
+        Parameters
+        ----------
+        star: str
+        table: table
+            Optional, result of the archive query (ARCFILE and Date Obs)
+        arcfiles: list of str
+            Optional, other ARCFILEs to mark (e.g. downloaded in older runs)
+        """
+        with self._lock:
+            entry = self.stars.setdefault(star, {'last_mjd': None, 'seen': set()})
+            entry['seen'].update(str(a) for a in arcfiles)
+            if table is None or len(table) == 0:
+                return
+            entry['seen'].update(str(a) for a in table['ARCFILE'])
+            if 'Date Obs' in colnames(table):
+                mjd = filters.mjd(table['Date Obs'])
+                mjd = mjd[np.isfinite(mjd)]
+                if len(mjd) > 0:
+                    last = float(np.max(mjd))
+                    if entry['last_mjd'] is None or last > entry['last_mjd']:
+                        entry['last_mjd'] = last
+
+    def save(self):
+        """
+        Write the state to its JSON file (replaced atomically)
+        """
+        with self._lock:
+            data = {star: {'last_mjd': e['last_mjd'], 'seen': sorted(e['seen'])}
+                    for star, e in self.stars.items()}
+            parte = self.path+'.part'
+            with open(parte, 'w') as f:
+                json.dump(data, f)
+            os.replace(parte, self.path)
@@ -0,0 +1,125 @@
+import io
+import numpy as np
+import eso_down.angle as tt
+
+#ObsCore columns asked in the bulk queries -> column names of query_surveys
+COLUMNS = {'dp_id': 'ARCFILE',
+           't_min': 'Date Obs',
+           'snr': 'SNR (spectra)',
+           's_ra': 'RA',
+           's_dec': 'DEC',
+           'em_res_power': 'R (&lambda;/&delta;&lambda;)'}
+
+def adql(ra, dec, radius, instruments=None, table='ivoa.ObsCore', since=None):
+    """
+    ADQL query of the spectra inside the cones of several targets
+
+    Parameters
+    ----------
+    ra, dec: array of float
+        Coordinates of the targets in degrees
+    radius: float
+        Radius of the cones in arcsec
+    instruments: list of str
+        Optional, names of the instruments (instrument_name)
+        Default: instruments = None (all)
+    table: str
+        Optional, Default: table = 'ivoa.ObsCore'
+    since: array of float
+        Optional, MJD of each target: only spectra with t_min >= since
+        (nan or None: no limit for that target)
+        Default: since = None
+
+    Returns
+    -------
+    query: str
+    """
+    r = radius/3600.
+    ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+    if since is None:
+        since = [None]*len(ra)
+    cones = []
+    for a, d, t in zip(ra, dec, since):
+        cone = "CONTAINS(POINT('ICRS', s_ra, s_dec), CIRCLE('ICRS', {:.7f}, {:.7f}, {:.7f})) = 1".format(a, d, r)
+        if t is not None and np.isfinite(t):
+            cone = '({} AND t_min >= {:.6f})'.format(cone, t)
+        cones.append(cone)
+    where = ["dataproduct_type = 'spectrum'", '({})'.format(' OR '.join(cones))]
+    if instruments is not None:
+        where.append('instrument_name IN ({})'.format(', '.join("'{}'".format(i) for i in np.atleast_1d(instruments))))
+    return 'SELECT {} FROM {} WHERE {}'.format(', '.join(COLUMNS), table, ' AND '.join(where))
+
+def mjd2iso(mjd):
+    """
+    ISO dates (millisecond precision) of MJDs, converted with numpy
+    datetime64 instead of astropy Time ('' for nan). Days with a leap
+    second can differ by less than a second from astropy
+    """
+    mjd = np.asarray(mjd, dtype=float)
+    ok = np.isfinite(mjd)
+    dates = np.full(len(mjd), '', dtype='U23')
+    if ok.any():
+        ms = np.round((mjd[ok] - 40587.)*86400000.).astype('int64')
+        dates[ok] = np.datetime_as_string(ms.astype('datetime64[ms]'), unit='ms')
+    return dates
+
+def parse(payload):
+    """
+    Answer of a bulk query as a table with the column names of
+    query_surveys ('Date Obs' converted from MJD to ISO dates)
+
+    Parameters
+    ----------
+    payload: bytes
+        Response of the TAP service, in CSV (read with the fast C reader)
+        or VOTable
+
+    Returns
+    -------
+    table: table
+        Astropy table
+    """
+    if payload.lstrip()[:1] == b'<':
+        from astropy.io.votable import parse_single_table
+        table = parse_single_table(io.BytesIO(payload)).to_table()
+    else:
+        from astropy.table import Table
+        table = Table.read(payload.decode(), format='ascii.csv', fast_reader=True)
+    table.rename_columns([c for c in COLUMNS if c in table.colnames],
+                         [COLUMNS[c] for c in COLUMNS if c in table.colnames])
+    if 'Date Obs' in table.colnames:
+        mjd = np.ma.filled(np.ma.asarray(table['Date Obs'], dtype=float), np.nan)
+        table['Date Obs'] = mjd2iso(mjd)
+    return table
+
+def split(table, ra, dec, radius):
+    """
+    Rows of a bulk query that belong to each target
+
+    Parameters
+    ----------
+    table: table
+        Result of parse
+    ra, dec: array of float
+        Coordinates of the targets in degrees
+    radius: float
+        Radius of the cones in arcsec
+
+    Returns
+    -------
+    tables: list of table
+        One table for each target (a row close to two targets is in both)
+    """
+    rows_ra = np.asarray(table['RA'], dtype=float)
+    rows_dec = np.asarray(table['DEC'], dtype=float)
+    #rows sorted by DEC: each cone only looks at its band of DEC
+    order = np.argsort(rows_dec)
+    sorted_dec = rows_dec[order]
+    tables = []
+    for a, d in zip(ra, dec):
+        lo = np.searchsorted(sorted_dec, d - radius/3600, side='left')
+        hi = np.searchsorted(sorted_dec, d + radius/3600, side='right')
+        band = order[lo:hi]
+        rows = band[tt.cone(rows_ra[band], rows_dec[band], a, d, radius)]
+        tables.append(table[np.sort(rows)])
+    return tables
@@ -0,0 +1,226 @@
+import random
+import threading
+import time
+
+#HTTP status that are worth retrying (throttling and server errors)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """
+    Rate limit: at most rate requests per second, with bursts of burst
+
+    Parameters
+    ----------
+    rate: float
+        Tokens added per second
+    burst: int
+        Optional, maximum number of tokens
+        Default: burst = rate (at least 1)
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst if burst is not None else rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, waiting for it if needed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens)/self.rate
+            time.sleep(wait)
+
+class AdaptiveLimiter:
+    """
+    Limit of simultaneous requests that adapts to the server (AIMD)
+
+    The limit is halved when the server throttles or fails and grows by
+    one after limit successful requests in a row.
+
+    Parameters
+    ----------
+    initial: int
+        Optional, starting limit
+        Default: initial = 4
+    minimum: int
+        Optional, Default: minimum = 1
+    maximum: int
+        Optional, Default: maximum = 16
+    """
+    def __init__(self, initial=4, minimum=1, maximum=16):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, success=True):
+        with self._cond:
+            self.active -= 1
+            if success:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self._successes = 0
+            else:
+                self.limit = max(self.minimum, self.limit//2)
+                self._successes = 0
+            self._cond.notify_all()
+
+def _retry_after(response):
+    """
+    Seconds asked by the server in the Retry-After header (None if absent)
+    """
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class RequestScheduler:
+    """
+    Rate limits, adaptive concurrency and retries for each endpoint
+
+    Parameters
+    ----------
+    rates: dict
+        Optional, endpoint -> (requests per second, burst)
+        Default: RequestScheduler.RATES
+    retries: int
+        Optional, number of retries after the first attempt
+        Default: retries = 5
+    backoff: float
+        Optional, base of the exponential backoff in seconds
+        Default: backoff = 0.5
+    max_backoff: float
+        Optional, maximum wait between attempts in seconds
+        Default: max_backoff = 60
+    concurrency: int
+        Optional, initial limit of simultaneous requests per endpoint
+        Default: concurrency = 4
+    max_concurrency: int
+        Optional, Default: max_concurrency = 16
+    """
+    RATES = {'datalink': (10, 20), 'dataportal': (5, 10), 'query': (2, 4), 'simbad': (5, 10)}
+
+    def __init__(self, rates=None, retries=5, backoff=0.5, max_backoff=60.,
+                 concurrency=4, max_concurrency=16):
+        self.rates = dict(self.RATES)
+        if rates:
+            self.rates.update(rates)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self._buckets = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        #endpoint -> {'calls', 'retries', 'failures'}
+        self.counts = {}
+
+    def _endpoint(self, name):
+        with self._lock:
+            if name not in self._buckets:
+                rate, burst = self.rates.get(name, (10, 20))
+                self._buckets[name] = TokenBucket(rate, burst)
+                self._limiters[name] = AdaptiveLimiter(self.concurrency, 1, self.max_concurrency)
+                self.counts[name] = {'calls': 0, 'retries': 0, 'failures': 0}
+            return self._buckets[name], self._limiters[name]
+
+    def _count(self, name, key):
+        with self._lock:
+            self.counts[name][key] += 1
+
+    def limit(self, name):
+        """
+        Current limit of simultaneous requests of an endpoint
+        """
+        return self._endpoint(name)[1].limit
+
+    def _wait(self, attempt, response=None):
+        wait = _retry_after(response) if response is not None else None
+        if wait is None:
+            #exponential backoff with full jitter
+            wait = random.uniform(0, min(self.max_backoff, self.backoff*2**attempt))
+        time.sleep(min(wait, self.max_backoff))
+
+    def _retryable(self, error):
+        import requests
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError)):
+            return True
+        response = getattr(error, 'response', None)
+        return getattr(response, 'status_code', None) in RETRY_STATUS
+
+    def call(self, name, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) under the limits of an endpoint,
+        retrying on throttling, server errors and connection errors
+
+        A result with a status_code in RETRY_STATUS (an HTTP response) is
+        retried as well, and returned as it is after the last attempt.
+
+        Parameters
+        ----------
+        name: str
+            Endpoint ('datalink', 'dataportal', 'query', 'simbad', ...)
+        function: function
+            The request
+
+        Returns
+        -------
+        result: object
+            What function returned
+        """
+        bucket, limiter = self._endpoint(name)
+        self._count(name, 'calls')
+        attempt = 0
+        while True:
+            bucket.acquire()
+            limiter.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                limiter.release(success=False)
+                if not self._retryable(error) or attempt >= self.retries:
+                    self._count(name, 'failures')
+                    raise
+                self._count(name, 'retries')
+                self._wait(attempt, getattr(error, 'response', None))
+                attempt += 1
+                continue
+            if getattr(result, 'status_code', None) in RETRY_STATUS:
+                limiter.release(success=False)
+                if attempt >= self.retries:
+                    self._count(name, 'failures')
+                    return result
+                self._count(name, 'retries')
+                self._wait(attempt, result)
+                if hasattr(result, 'close'):
+                    result.close()
+                attempt += 1
+                continue
+            limiter.release(success=True)
+            return result
+
+    def request(self, name, session, method, url, **kwargs):
+        """
+        HTTP request through call, e.g. request('datalink', session, 'GET', url)
+        """
+        return self.call(name, session.request, method, url, **kwargs)